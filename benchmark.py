@@ -0,0 +1,307 @@
+"""
+Benchmarks for export_things.py on a synthetic Things 3 database.
+
+    $ python3 benchmark.py memory --tasks 100000
+    $ python3 benchmark.py engines
+    $ python3 benchmark.py output
+    $ python3 benchmark.py render
+
+The synthetic database has the tables and columns the exporter reads, with
+areas, projects, headings, tags and checklists in roughly the proportions
+of a real database. It is created next to the script and reused by later
+runs with the same number of tasks.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sqlite3
+import time
+import tracemalloc
+
+import export_things
+
+SCHEMA = """
+    CREATE TABLE Meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE TMArea (uuid TEXT PRIMARY KEY, title TEXT, visible INTEGER, "index" INTEGER);
+    CREATE TABLE TMTask (uuid TEXT PRIMARY KEY, trashed INTEGER, type INTEGER, title TEXT, notes TEXT,
+                         deadline INTEGER, status INTEGER, stopDate REAL, start INTEGER, startDate INTEGER,
+                         "index" INTEGER, todayIndex INTEGER, area TEXT, project TEXT, heading TEXT,
+                         checklistItemsCount INTEGER);
+    CREATE TABLE TMTag (uuid TEXT PRIMARY KEY, title TEXT, shortcut TEXT, usedDate REAL, parent TEXT,
+                        "index" INTEGER);
+    CREATE TABLE TMTaskTag (tasks TEXT NOT NULL, tags TEXT NOT NULL);
+    CREATE TABLE TMAreaTag (areas TEXT NOT NULL, tags TEXT NOT NULL);
+    CREATE TABLE TMChecklistItem (uuid TEXT PRIMARY KEY, title TEXT, status INTEGER, stopDate REAL,
+                                  "index" INTEGER, task TEXT);
+    CREATE INDEX index_TMTask_area ON TMTask(area);
+    CREATE INDEX index_TMTask_project ON TMTask(project);
+    CREATE INDEX index_TMTask_heading ON TMTask(heading);
+    CREATE INDEX index_TMTask_type ON TMTask(type);
+    CREATE INDEX index_TMTaskTag_tasks ON TMTaskTag(tasks);
+    CREATE INDEX index_TMAreaTag_areas ON TMAreaTag(areas);
+    CREATE INDEX index_TMChecklistItem_task ON TMChecklistItem(task);
+"""
+
+DATABASE_VERSION = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<integer>24</integer>
+</plist>"""
+
+TAGS = ('Home', 'Office', 'Errand', 'Important', 'Idea', 'Blocked', 'read later', 'high-energy')
+
+TASKS_PER_PROJECT = 40
+PROJECTS_PER_AREA = 10
+HEADINGS_PER_PROJECT = 2
+
+
+def things_date(year, month, day):
+    return year << 16 | month << 12 | day << 7
+
+
+def make_database(path, tasks, seed=1):
+    """Create a synthetic database with the given number of tasks."""
+    rng = random.Random(seed)
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    con.execute("INSERT INTO Meta VALUES ('databaseVersion', ?)", (DATABASE_VERSION,))
+    con.executemany('INSERT INTO TMTag (uuid, title, "index") VALUES (?, ?, ?)',
+                    [('tag-%s' % i, title, i) for i, title in enumerate(TAGS)])
+
+    def random_date():
+        return rng.choice((None, None, None, things_date(2024, rng.randint(1, 12), rng.randint(1, 28))))
+
+    def random_notes():
+        return rng.choice((None, '', 'a short note', 'a note\nwith two lines',
+                           '<note xml:space="preserve">see <a href="https://example.com">here</a></note>'))
+
+    project_count = max(1, tasks // TASKS_PER_PROJECT)
+    area_count = max(1, project_count // PROJECTS_PER_AREA)
+    areas = ['area-%s' % i for i in range(area_count)]
+    con.executemany('INSERT INTO TMArea (uuid, title, "index") VALUES (?, ?, ?)',
+                    [(uuid, 'Area %s' % i, i) for i, uuid in enumerate(areas)])
+    con.executemany('INSERT INTO TMAreaTag VALUES (?, ?)',
+                    [(uuid, 'tag-%s' % rng.randrange(len(TAGS))) for uuid in areas[::3]])
+
+    rows = []
+    headings = []
+    for i in range(project_count):
+        uuid = 'project-%s' % i
+        rows.append((uuid, 0, 1, 'Project %s' % i, random_notes(), random_date(), 0, None,
+                     rng.choice((1, 1, 2)), random_date(), i, None,
+                     rng.choice(areas + [None]), None, None, 0))
+        for j in range(HEADINGS_PER_PROJECT):
+            headings.append('heading-%s-%s' % (i, j))
+            rows.append((headings[-1], 0, 2, 'Heading %s' % j, None, None, 0, None, 1, None, j, None,
+                         None, uuid, None, 0))
+
+    checklist = []
+    task_tags = []
+    for i in range(tasks):
+        uuid = 'task-%s' % i
+        project = heading = area = None
+        where = rng.random()
+        if where < 0.05:
+            pass  # inbox
+        elif where < 0.1:
+            area = rng.choice(areas)
+        elif where < 0.5:
+            project = 'project-%s' % rng.randrange(project_count)
+        else:
+            heading = rng.choice(headings)
+        checklist_count = rng.choice((0, 0, 0, 0, 0, 0, 0, 3))
+        rows.append((uuid, int(rng.random() < 0.05), 0, 'Task %s with a title of typical length' % i,
+                     random_notes(), random_date(), rng.choice((0, 0, 0, 0, 3)), None,
+                     rng.choice((0, 1, 1, 2)), random_date(), i, None, area, project, heading,
+                     checklist_count))
+        for j in range(checklist_count):
+            checklist.append(('item-%s-%s' % (i, j), 'Item %s' % j, rng.choice((0, 3)), None, j, uuid))
+        for tag in rng.sample(range(len(TAGS)), rng.choice((0, 0, 1, 2))):
+            task_tags.append((uuid, 'tag-%s' % tag))
+
+    con.executemany('INSERT INTO TMTask VALUES (%s)' % ', '.join('?' * 16), rows)
+    con.executemany('INSERT INTO TMChecklistItem VALUES (?, ?, ?, ?, ?, ?)', checklist)
+    con.executemany('INSERT INTO TMTaskTag VALUES (?, ?)', task_tags)
+    con.commit()
+    con.close()
+
+
+def database(args):
+    path = 'benchmark-%s.sqlite' % args.tasks
+    if not os.path.exists(path):
+        print("creating %s..." % path)
+        make_database(path, args.tasks)
+    return path
+
+
+def measure(function):
+    """
+    Return the result of function, the memory it still holds and the time it took.
+
+    The time is taken in a second call without tracemalloc, which slows down
+    every allocation (and so the stores with many small objects) a lot.
+    """
+    tracemalloc.start()
+    result = function()
+    size = tracemalloc.take_snapshot().statistics('filename')
+    tracemalloc.stop()
+    started = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - started
+    return result, sum(stat.size for stat in size), elapsed
+
+
+class RowWrapper(object):
+    """The attributes every exported item had when it wrapped a sqlite3.Row."""
+
+    def __init__(self, row, loader, args, level=0):
+        self.row = row
+        self.loader = loader
+        self.args = args
+        self.level = level
+        self._tags = []
+        self._priority = None
+        self._blocked = None
+        self._idea = False
+
+
+def bench_memory(args):
+    path = database(args)
+
+    def load_rows():
+        con = sqlite3.connect(path)
+        con.row_factory = sqlite3.Row
+        schema = export_things.Schema.probe(con)
+        tasks = [RowWrapper(row, None, args) for row in con.execute(schema.sql(export_things.BulkLoader.TASKS))]
+        items = [RowWrapper(row, None, args) for row in con.execute(export_things.CheckListItem.ALL_ITEMS)]
+        return tasks, items
+
+    def load_records():
+        con = sqlite3.connect(path)
+        return export_things.BulkLoader(con).load()
+
+    def load_columns():
+        con = sqlite3.connect(path)
+        return export_things.ColumnarStore(con).load()
+
+    (tasks, items), rows_size, rows_time = measure(load_rows)
+    areas, records_size, records_time = measure(load_records)
+    areas, columns_size, columns_time = measure(load_columns)
+    print("%s tasks, projects and headings, %s checklist items" % (len(tasks), len(items)))
+    print("sqlite3.Row wrappers: %6.0f bytes per task (%.0f MB, %.2f s)"
+          % (rows_size / len(tasks), rows_size / 1e6, rows_time))
+    print("slotted records:      %6.0f bytes per task (%.0f MB, %.2f s)"
+          % (records_size / len(tasks), records_size / 1e6, records_time))
+    print("columnar store:       %6.0f bytes per task (%.0f MB, %.2f s)"
+          % (columns_size / len(tasks), columns_size / 1e6, columns_time))
+
+
+def bench_engines(args):
+    """Time a complete export (output to /dev/null) with each engine."""
+    path = database(args)
+    for engine in sorted(export_things.LOADERS):
+        export_args = argparse.Namespace(database=path, engine=engine, called_from_gui=True)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            export_things.export(export_args)
+            elapsed = time.perf_counter() - started
+        print("%-10s %.2f s" % (engine, elapsed))
+
+
+class PrintSink(object):
+    """How the exporter wrote its output before OutputSink: one print() per line."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def write_line(self, line):
+        print(line, file=self.file)
+
+    def close(self):
+        self.file.flush()
+
+
+class CountingFileIO(io.FileIO):
+    """A raw file that counts its write() system calls and the lines written."""
+
+    writes = 0
+    lines = 0
+
+    def write(self, b):
+        self.writes += 1
+        self.lines += bytes(b).count(b'\n')
+        return super().write(b)
+
+
+def bench_output(args):
+    """Render the same export with print() per line and with OutputSink."""
+    con = sqlite3.connect(database(args))
+    areas = export_things.BulkLoader(con).load()
+    con.close()
+    for buffering in ('block', 'line'):
+        for sink in (PrintSink, export_things.OutputSink):
+            raw = CountingFileIO(os.devnull, 'w')
+            file = io.TextIOWrapper(io.BufferedWriter(raw), line_buffering=buffering == 'line')
+            out = sink(file)
+            started = time.perf_counter()
+            for area in areas:
+                area.export(out)
+            out.close()
+            elapsed = time.perf_counter() - started
+            file.close()
+            print("%-10s %s-buffered file: %s lines in %.2f s, %s writes"
+                  % (sink.__name__, buffering, raw.lines, elapsed, raw.writes))
+
+
+# the line template of each item class, as rendered before compile_template
+TEMPLATES = {
+    export_things.Area: export_things.Area.AREA_TEMPLATE,
+    export_things.Project: export_things.Project.PROJECT_TEMPLATE,
+    export_things.Task: export_things.Task.TASK_TEMPLATE,
+    export_things.Heading: export_things.Heading.ACTIONGROUP_TEMPLATE,
+    export_things.CheckListItem: export_things.CheckListItem.CHECKLIST_ITEM_TEMPLATE,
+}
+
+
+def bench_render(args):
+    """Time rendering the first line of every item with TEMPLATE % item and with the compiled renderer."""
+    con = sqlite3.connect(database(args))
+    areas = export_things.BulkLoader(con).load()
+    con.close()
+    items = {}
+    for area in areas:
+        for item in area.walk():
+            items.setdefault(type(item), []).append(item)
+    for cls, template in TEMPLATES.items():
+        lines = items.get(cls, ())
+        if not lines:
+            continue
+        started = time.perf_counter()
+        old = [template % item for item in lines]
+        old_time = time.perf_counter() - started
+        started = time.perf_counter()
+        new = [item.render_line() for item in lines]
+        new_time = time.perf_counter() - started
+        assert old == new
+        print("%-14s %6s lines: %4.0f ns per line with %%, %4.0f ns compiled"
+              % (cls.__name__, len(lines), old_time / len(lines) * 1e9, new_time / len(lines) * 1e9))
+
+
+BENCHMARKS = {
+    'engines': bench_engines,
+    'memory': bench_memory,
+    'output': bench_output,
+    'render': bench_render,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the Things3 exporter on a synthetic database.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--tasks', dest='tasks', type=int, default=100000,
+                        help='number of tasks in the synthetic database (default: 100000)')
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -1,11 +1,25 @@
 import argparse
-from datetime import datetime, date
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime, date, timezone
+import hashlib
+from itertools import groupby
+import io
+import json
 import logging
 import os
 import re
 import sqlite3
 import sys
+import tarfile
+import tempfile
+import time
+from urllib.parse import quote
+from xml.sax.saxutils import XMLGenerator
 from math import floor
+from operator import attrgetter, itemgetter
+import zipfile
 
 """
 Export Things 3 database to TaskPaper files
@@ -27,6 +41,39 @@ Database Structure:
 
 DEFAULT_TARGET = 'Things3 export'
 
+ENGINE_BULK = 'bulk'
+ENGINE_QUERY = 'query'
+ENGINE_COLUMNAR = 'columnar'
+ENGINE_STREAM = 'stream'
+ENGINE_RECURSIVE = 'recursive'
+
+# size of the per-connection prepared statement cache, large enough to keep
+# every statement used by the exporter
+CACHED_STATEMENTS = 256
+
+# pragmas for read-only connections: map the database file into memory and
+# keep caches and temporary b-trees (e.g. for ORDER BY) in RAM
+READONLY_PRAGMAS = (
+    'PRAGMA mmap_size = 268435456;',  # 256 MB
+    'PRAGMA cache_size = -65536;',  # 64 MB
+    'PRAGMA temp_store = MEMORY;',
+)
+
+# number of pages copied per step when taking a snapshot
+SNAPSHOT_PAGES = 1024
+
+# snapshots get the indexes of the engine for tables with at least this many
+# rows, and keep those that save more time than they take to build, estimated
+# from a sample of queries
+INDEX_MIN_ROWS = 10000
+INDEX_SAMPLE = 20
+
+# the permissions of a new file, for temporary files that replace export files
+# (mkstemp creates them readable by the owner only)
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
 
 def export(args):
     try:
@@ -35,43 +82,735 @@ def export(args):
         # log to file only if not called from guo
         logging.basicConfig(filename='export.log', level=logging.DEBUG)
 
-    con = sqlite3.connect(args.database)
+    emitter = EMITTERS[getattr(args, 'emitter', OrgEmitter.NAME)]()
+    if isinstance(emitter, CSVEmitter):
+        return export_table(args, emitter)
+    if isinstance(emitter, SQLiteEmitter) and (getattr(args, 'archive', None) or getattr(args, 'stdout', False)):
+        raise ValueError("the %s emitter writes a database file, not to --stdout or --archive" % emitter.NAME)
+    con = connect(args)
+    engine = LOADERS[getattr(args, 'engine', ENGINE_BULK)]
+    if getattr(args, 'snapshot', False):
+        create_indexes(con, engine.INDEXES)
+
+    # the sink is only created once the database is open, and aborted (its
+    # temporary files removed) if the export fails
+    out = make_sink(args, emitter)
+    try:
+        # read everything in one transaction, so the export is a consistent
+        # snapshot and the database is locked for as short as possible
+        started = time.perf_counter()
+        con.execute('BEGIN')
+        loader = engine(con)
+        if loader.STREAMING:
+            for item in loader.stream(notes=getattr(args, 'notes', True)):
+                out.write_item(item)
+            end_read_transaction(con, started)
+        else:
+            areas = loader.load(notes=getattr(args, 'notes', True))
+            end_read_transaction(con, started)
+        logging.debug("%s queries executed, %s distinct statements, statement cache hit rate: %.1f%%",
+                      loader.queries, len(loader.statements), loader.statement_cache_hit_rate * 100)
+        con.close()
+
+        if not loader.STREAMING:
+            for area in areas:
+                for item in area.walk():
+                    out.write_item(item)
+    except BaseException:
+        out.abort()
+        raise
+    out.close()
+
+
+def make_sink(args, emitter):
+    """Return the sink for the output options of args."""
+    if isinstance(emitter, SQLiteEmitter):
+        return DatabaseSink(args.target, emitter)
+    if getattr(args, 'archive', None):
+        return ArchiveLayout(args.archive, args.target, getattr(args, 'format', RowObject.FMT_PROJECT), emitter)
+    if getattr(args, 'stdout', True):
+        return OutputSink(sys.stdout, emitter)
+    return FileLayout(args.target, getattr(args, 'format', RowObject.FMT_PROJECT), emitter)
+
+
+def export_table(args, emitter):
+    """Write the tasks as a table (see CSVEmitter) to stdout or the file target."""
+    if getattr(args, 'archive', None):
+        raise ValueError("the %s emitter writes one file, not an --archive" % emitter.NAME)
+    started = time.perf_counter()
+    con = connect(args)
+    schema = Schema.probe(con)
+    con.execute('BEGIN')
+    cursor = con.execute(schema.sql(emitter.TASKS))
+    if getattr(args, 'stdout', True):
+        rows = emitter.write_table(cursor, sys.stdout)
+        sys.stdout.flush()
+        path = '<stdout>'
+    else:
+        path = args.target
+        if not os.path.splitext(path)[1]:
+            path = emitter.FILE_TMPL % path
+        fd, temp = make_temp_file(os.path.dirname(path) or '.')
+        try:
+            with open(fd, 'w', encoding=emitter.ENCODING, newline='') as f:
+                rows = emitter.write_table(cursor, f)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+    end_read_transaction(con, started)
+    con.close()
+    logging.info("%s: %s tasks written in %.3f s", path, rows, time.perf_counter() - started)
+
+
+def explain(args):
+    """
+    Print the query plan of every export query, the slowest first.
+
+    The per-level queries are timed during a complete load with the query
+    engine, the single-pass queries of the other engines (which run once per
+    export) are run once each. Plan steps that scan a whole table, build a
+    temporary b-tree (e.g. for an ORDER BY no index delivers) or an
+    automatic index are flagged.
+    """
+    con = connect(args)
+    if getattr(args, 'snapshot', False):
+        create_indexes(con, QueryLoader.INDEXES)
+    loader = QueryLoader(con)
+    loader.profile = {}
+    loader.load(notes=getattr(args, 'notes', True))
+    for query in Schema.QUERIES:
+        if query not in loader.profile and '?' not in query:
+            loader.query(query)
+
+    tables = {name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+    names = query_names()
+    total = sum(seconds for calls, seconds in loader.profile.values())
+    unused = [query for query in Schema.QUERIES if query not in loader.profile]
+    profile = sorted(loader.profile.items(), key=lambda item: item[1][1], reverse=True)
+    profile.extend((query, (0, 0.0)) for query in unused)
+    for query, (calls, seconds) in profile:
+        sql = loader.schema.sql(query)
+        print("\n%s: %s calls, %.3f s (%.1f%%)" % (names.get(query, ' '.join(sql.split())[:60]), calls,
+                                                 seconds, seconds / total * 100 if total else 0))
+        for line in query_plan(con, sql, tables):
+            print(line)
+    con.close()
+
 
-    con.row_factory = sqlite3.Row
+def query_names():
+    """Return the name (e.g. Task.TASKS_IN_PROJECT) of each query constant."""
+    names = {}
+    for cls in (TagIndex, RowObjectWithTags, Area, Project, Task, CheckListItem, QueryLoader, BulkLoader,
+                ColumnarStore, StreamLoader, RecursiveLoader):
+        for name, value in vars(cls).items():
+            if value in Schema.QUERIES:
+                names.setdefault(value, '%s.%s' % (cls.__name__, name))
+    return names
+
+
+def query_plan(con, sql, tables):
+    """Return the lines of the plan of sql, with full scans, temp b-trees and automatic indexes flagged."""
+    aliases = {}
+    for name, alias in re.findall(r'(?:FROM|JOIN)\s+(\w+)(?:\s+AS\s+(\w+))?', sql):
+        aliases.setdefault(alias or name, set()).add(name)
+    params = (None,) * sql.count('?')
+    depths = {0: 0}
+    lines = []
+    for node, parent, _, detail in con.execute('EXPLAIN QUERY PLAN ' + sql, params):
+        depths[node] = depths.get(parent, 0) + 1
+        flag = ''
+        scan = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+        if scan and (aliases.get(scan.group(1), set()) | {scan.group(1)}) & tables:
+            flag = '  <-- full scan'
+        elif 'TEMP B-TREE' in detail:
+            flag = '  <-- temp b-tree'
+        elif 'AUTOMATIC' in detail:
+            flag = '  <-- automatic index'
+        lines.append('%s%s%s' % ('  ' * depths[node], detail, flag))
+    return lines
+
+
+def connect(args):
+    """
+    Open the database, or an in-memory snapshot of it with --snapshot.
+
+    With --readonly the database is opened through a read-only URI, which
+    never takes write locks on the live Things database and allows mmap I/O.
+    --immutable additionally tells SQLite that the file cannot change (so it
+    does no locking at all); only use it when Things is closed.
+    """
+    con = open_database(args)
+    if getattr(args, 'snapshot', False):
+        con = snapshot(con)
+    return con
+
+
+def open_database(args):
+    readonly = getattr(args, 'readonly', False)
+    immutable = getattr(args, 'immutable', False)
+    if not (readonly or immutable):
+        return sqlite3.connect(args.database, cached_statements=CACHED_STATEMENTS)
+
+    uri = 'file:%s?mode=ro' % quote(os.path.abspath(args.database))
+    if immutable:
+        uri += '&immutable=1'
+    con = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS)
+    for pragma in READONLY_PRAGMAS:
+        con.execute(pragma)
+    logging.info("opened %s", uri)
+    return con
+
+
+def snapshot(con):
+    """
+    Copy the database (including changes still in its write-ahead log) into
+    memory and close the original connection.
 
-    c = con.cursor()
-    no_area = Area(dict(uuid='NULL', title='no area'), con, args)
-    no_area.export()
-    for row in c.execute(Area.QUERY):
-        a = Area(row, con, args)
-        a.export()
+    The database is only read while copying, all export queries run against
+    the copy.
+    """
+    started = time.perf_counter()
+    mem = sqlite3.connect(':memory:', cached_statements=CACHED_STATEMENTS)
+    con.backup(mem, pages=SNAPSHOT_PAGES)
     con.close()
+    page_count = mem.execute('PRAGMA page_count;').fetchone()[0]
+    page_size = mem.execute('PRAGMA page_size;').fetchone()[0]
+    logging.info("snapshot: %s pages (%.1f MB) copied in %.3f s",
+                 page_count, page_count * page_size / 1024 / 1024, time.perf_counter() - started)
+    return mem
+
+
+def create_indexes(con, indexes):
+    """
+    Create the indexes (see QueryLoader.INDEXES) on a snapshot.
+
+    Only tables with at least INDEX_MIN_ROWS rows are indexed, on smaller
+    tables building an index takes about as long as it saves. The query time
+    an index saves is estimated by running its query for INDEX_SAMPLE parents
+    before and after building it, and the index is dropped again if that is
+    less than its build time.
+
+    Never call this for the live database, the indexes would be saved in it.
+    """
+    schema = Schema.probe(con)
+    for name, columns, query, parents in indexes:
+        table = columns.split()[0]
+        rows, = con.execute('SELECT count(*) FROM %s;' % table).fetchone()
+        if rows < INDEX_MIN_ROWS:
+            logging.info("index %s not needed, %s has %s rows", name, table, rows)
+            continue
+        sql = schema.sql(query)
+        parents = con.execute(schema.sql(parents)).fetchall()
+        sample = parents[:INDEX_SAMPLE]
+        before = time_queries(con, sql, sample)
+        started = time.perf_counter()
+        con.execute(schema.sql('CREATE INDEX IF NOT EXISTS %s ON %s;' % (name, columns)))
+        built = time.perf_counter() - started
+        saved = (before - time_queries(con, sql, sample)) * len(parents) / max(len(sample), 1)
+        if saved < built:
+            con.execute('DROP INDEX %s;' % name)
+            logging.info("index %s dropped, built in %.3f s but saves only about %.3f s in %s queries",
+                         name, built, saved, len(parents))
+        else:
+            logging.info("index %s built in %.3f s, saves about %.3f s in %s queries",
+                         name, built, saved, len(parents))
+
+
+def time_queries(con, sql, params):
+    """Return the time it takes to run sql (and fetch all rows) for each of params."""
+    started = time.perf_counter()
+    for p in params:
+        con.execute(sql, p).fetchall()
+    return time.perf_counter() - started
+
+
+def make_temp_file(folder):
+    """Create a temporary file in folder with the permissions of a new file, return its fd and path."""
+    fd, temp = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    os.fchmod(fd, FILE_MODE)
+    return fd, temp
+
+
+def end_read_transaction(con, started):
+    con.rollback()
+    logging.info("read transaction held for %.3f s", time.perf_counter() - started)
+
+
+def make_tag(title):
+    return title.replace(' ', '_').replace('-', '_')
+
+
+TEMPLATE_FIELD = re.compile(r'%\((\w+)\)s')
+
+
+def compile_template(template):
+    """
+    Return a function that renders template (with %(name)s fields) for an item.
+
+    All fields are read with one attrgetter and formatted positionally, instead
+    of looking up every field through __getitem__. Assigned in a class body the
+    function becomes a method, e.g. render_line = compile_template(TEMPLATE).
+    """
+    names = TEMPLATE_FIELD.findall(template)
+    fields = attrgetter(*names)
+    template = TEMPLATE_FIELD.sub('%s', template)
+    if len(names) == 1:
+        return lambda item: template % (fields(item),)
+    return lambda item: template % fields(item)
+
+
+class OutputSink(object):
+    """
+    Collect the exported lines and write them to a file object in large chunks.
+
+    Items write their lines to the sink instead of printing them, the caller
+    chooses where they go (stdout, a file, an archive member). Lines are
+    joined and written at once when they add up to BUFFER_SIZE characters, so
+    small exports are written with a single write(), memory stays bounded
+    for larger ones and a reader of a pipe gets the lines while the export
+    runs.
+    end() ends the document of the emitter (e.g. closes a JSON array) and
+    writes the rest, close() also flushes the file object but does not close
+    it.
+    """
+
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, file, emitter=None, path=None):
+        self.file = file
+        self.emitter = emitter or OrgEmitter()
+        # the path file will be written to (see FileLayout)
+        self.path = path
+        self.lines = []
+        self.size = 0
+        self.emitter.begin(self)
+
+    def write_line(self, line):
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if self.size >= self.BUFFER_SIZE:
+            self.flush()
+
+    def write_item(self, item):
+        self.emitter.emit(item, self)
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            self.file.write('\n'.join(self.lines))
+            self.lines = []
+            self.size = 0
+
+    def end(self):
+        self.emitter.end(self)
+        self.flush()
+
+    def close(self):
+        self.end()
+        self.file.flush()
+
+    def abort(self):
+        """Called instead of close() when the export failed."""
+        pass
+
+
+class FileLayout(object):
+    """
+    Write the exported items into files below target.
+
+    Depending on the format, everything goes into one file (target, with the
+    FILE_TMPL of the emitter applied if it has no extension), into one file per area, or
+    into one folder per area with one file per project (tasks that are not
+    in a project go into a file named after the area). Each file is rendered
+    into its own buffer. When it is complete it is written by a pool of
+    WRITERS threads while the next files are rendered. Creating files is
+    slow on APFS and network volumes, and this way those writes run in
+    parallel.
+
+    The SHA-256 of every file is kept in a manifest next to the files
+    (MANIFEST with the name of the emitter in the target folder, or
+    .<file name>.things-export.json for one file). Files are only written if
+    their content has changed, through a temporary file that is renamed over
+    the old one. Files written by an earlier export with the same emitter
+    that are not part of this one (e.g. of a deleted project) are removed,
+    with their folder if it is empty then. The files of other emitters in the
+    same target are left alone.
+    """
+
+    WRITERS = 8
+    MANIFEST = '.things-export.%s.json'
+
+    def __init__(self, target, format, emitter=None):
+        if format not in RowObject.FORMATS:
+            raise ValueError("unknown format: %s" % format)
+        self.target = target
+        self.format = format
+        self.emitter = emitter or OrgEmitter()
+        self.paths = set()
+        self.pool = ThreadPoolExecutor(max_workers=self.WRITERS)
+        self.writes = []
+        self.out = self.area_out = None
+        self.area_path = None
+        self.area_items = 0
+        self.started = time.perf_counter()
+        if format == RowObject.FMT_ALL:
+            if not os.path.splitext(target)[1]:
+                target = self.emitter.FILE_TMPL % target
+            self.root = os.path.dirname(target) or '.'
+            self.manifest_path = os.path.join(self.root, '.%s.things-export.json' % os.path.basename(target))
+            self.open(target)
+        else:
+            self.root = target
+            self.manifest_path = os.path.join(target, self.MANIFEST % self.emitter.NAME)
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        """Return the hashes of the last export, by path relative to root."""
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)['files']
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    @staticmethod
+    def file_name(title):
+        name = (title or '').replace('/', '-').replace(':', '-').strip()
+        if not name:
+            return 'untitled'
+        # neither . nor .. (which would leave target) nor a hidden file
+        if name.startswith('.'):
+            return '_' + name
+        return name
+
+    def unique_path(self, *names):
+        """
+        Return the path for names below target, numbered if it is taken already.
+
+        Paths are compared case-insensitively, as on the default file systems
+        of macOS and Windows.
+        """
+        path = os.path.join(self.target, *names[:-1])
+        name = self.file_name(names[-1])
+        candidate = os.path.join(path, self.emitter.FILE_TMPL % name)
+        n = 1
+        while candidate.casefold() in self.paths:
+            n += 1
+            candidate = os.path.join(path, self.emitter.FILE_TMPL % ('%s (%s)' % (name, n)))
+        self.paths.add(candidate.casefold())
+        return candidate
+
+    def open(self, path):
+        self.out = OutputSink(io.StringIO(), self.emitter, path)
+        return self.out
+
+    def submit(self, out):
+        """Write the file of out in the pool."""
+        out.end()
+        self.writes.append(self.pool.submit(self.write_file, out.path, out.file.getvalue()))
+
+    def write_file(self, path, text):
+        """Write text to path unless it is unchanged, return the relative path, hash and whether it was written."""
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        name = os.path.relpath(path, self.root)
+        if self.manifest.get(name) == digest and os.path.exists(path):
+            return name, digest, False
+        self.replace_file(path, data)
+        return name, digest, True
+
+    @staticmethod
+    def replace_file(path, data):
+        """Atomically replace the file at path with data."""
+        folder = os.path.dirname(path) or '.'
+        os.makedirs(folder, exist_ok=True)
+        fd, temp = make_temp_file(folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def write_item(self, item):
+        if self.format == RowObject.FMT_AREA and isinstance(item, Area):
+            if self.out is not None:
+                self.submit(self.out)
+            self.open(self.unique_path(item.title))
+        elif self.format == RowObject.FMT_PROJECT:
+            if isinstance(item, Area):
+                self.end_area()
+                self.area_path = self.file_name(item.title)
+                self.area_out = self.out = self.open(self.unique_path(self.area_path, item.title))
+                self.area_items = 0
+            elif item.level == 1:
+                if self.out is not self.area_out:
+                    self.submit(self.out)
+                if isinstance(item, Project):
+                    self.open(self.unique_path(self.area_path, item.title))
+                else:
+                    self.out = self.area_out
+                    self.area_items += 1
+        self.emitter.emit(item, self.out)
+
+    def end_area(self):
+        """Submit the current files of the area, the area file only if it has tasks."""
+        if self.out is not None and self.out is not self.area_out:
+            self.submit(self.out)
+        if self.area_out is not None and self.area_items:
+            self.submit(self.area_out)
+        self.out = self.area_out = None
+
+    def submit_rest(self):
+        """Submit the files that are still open and wait for all writes."""
+        if self.format == RowObject.FMT_PROJECT:
+            self.end_area()
+        elif self.out is not None:
+            self.submit(self.out)
+        self.pool.shutdown()
+
+    def close(self):
+        self.submit_rest()
+        files = {}
+        written = 0
+        for write in self.writes:
+            name, digest, changed = write.result()
+            files[name] = digest
+            written += changed
+        deleted = self.delete_stale(files)
+        self.replace_file(self.manifest_path, json.dumps(dict(files=files), indent=1, sort_keys=True).encode('utf-8'))
+        logging.info("%s: %s files written, %s unchanged, %s deleted in %.3f s", self.target, written,
+                     len(files) - written, deleted, time.perf_counter() - self.started)
+
+    def abort(self):
+        """Stop the writes of a failed export, the files written so far stay (without a manifest)."""
+        self.pool.shutdown(cancel_futures=True)
+
+    def delete_stale(self, files):
+        """Delete the files of the last export that are not in files, return their number."""
+        deleted = 0
+        root = os.path.realpath(self.root)
+        for name in set(self.manifest) - set(files):
+            path = os.path.join(self.root, name)
+            # never delete outside root, for names like ../x in the manifest
+            if os.path.commonpath([root, os.path.realpath(path)]) != root:
+                logging.warning("not deleting %s, it is not below %s", path, self.root)
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            deleted += 1
+            folder = os.path.dirname(path)
+            if os.path.abspath(folder) != os.path.abspath(self.root):
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    pass  # not empty
+        return deleted
+
+
+class ArchiveLayout(FileLayout):
+    """
+    Write the files of a FileLayout into a tar.gz, tar.xz or zip archive.
+
+    The rendered buffers are added to the archive directly, without files on
+    disk. A single background thread adds them (archives are written
+    sequentially) and compresses while the next files are rendered. The
+    archive is written to a temporary file that replaces path when it is
+    complete. Members are named like the files below target, relative to the
+    folder of target.
+    """
+
+    WRITERS = 1
+    # archive suffix: tarfile stream mode, or None for zip
+    TAR_MODES = (
+        ('.tar.gz', 'w|gz'),
+        ('.tgz', 'w|gz'),
+        ('.tar.xz', 'w|xz'),
+        ('.txz', 'w|xz'),
+        ('.tar', 'w|'),
+        ('.zip', None),
+    )
+
+    def __init__(self, path, target, format, emitter=None):
+        for suffix, mode in self.TAR_MODES:
+            if path.endswith(suffix):
+                break
+        else:
+            raise ValueError("unknown archive type: %s (use one of %s)"
+                             % (path, ', '.join(suffix for suffix, mode in self.TAR_MODES)))
+        super().__init__(os.path.basename(target), format, emitter)
+        self.path = path
+        self.size = 0
+        fd, self.temp = make_temp_file(os.path.dirname(path) or '.')
+        self.file = os.fdopen(fd, 'wb')
+        if mode is None:
+            self.archive = zipfile.ZipFile(self.file, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(fileobj=self.file, mode=mode)
+
+    def read_manifest(self):
+        return {}
+
+    def write_file(self, path, text):
+        data = text.encode('utf-8')
+        self.size += len(data)
+        if isinstance(self.archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(path, time.localtime()[:6])
+            # the permissions of new files, like the files of FileLayout
+            info.external_attr = (0o100000 | FILE_MODE) << 16  # a regular file
+            self.archive.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED)
+        else:
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = FILE_MODE
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.submit_rest()
+        try:
+            for write in self.writes:
+                write.result()
+            self.archive.close()
+            self.file.close()
+        except BaseException:
+            self.file.close()
+            os.unlink(self.temp)
+            raise
+        os.replace(self.temp, self.path)
+        logging.info("%s: %s files (%.1f MB) compressed to %.1f MB in %.3f s", self.path, len(self.writes),
+                     self.size / 1e6, os.path.getsize(self.path) / 1e6, time.perf_counter() - self.started)
+
+    def abort(self):
+        """Stop the writes of a failed export and remove the unfinished archive."""
+        self.pool.shutdown(cancel_futures=True)
+        try:
+            self.archive.close()
+        except Exception:
+            pass
+        self.file.close()
+        os.unlink(self.temp)
+
+
+class TagIndex(object):
+    """
+    Normalized tags of all tasks and areas, keyed by uuid.
+
+    Task tags are split into plain tags and keywords: the tags Idea, Important
+    and Blocked are not exported as tags but change the org-mode keyword or
+    priority of the task (see TaskObjects.org_todo_keyword and priority).
+    """
+
+    TASK_TAGS = """
+        SELECT tt.tasks AS uuid, tag.title AS title FROM TMTaskTag AS tt, TMTag AS tag
+        WHERE tt.tags = tag.uuid
+        ORDER BY tt.rowid;
+    """
+    AREA_TAGS = """
+        SELECT at.areas AS uuid, tag.title AS title FROM TMAreaTag AS at, TMTag AS tag
+        WHERE at.tags = tag.uuid
+        ORDER BY at.rowid;
+    """
+    KEYWORDS = frozenset(('Idea', 'Important', 'Blocked'))
+    NO_TASK_TAGS = ((), frozenset())
+
+    def __init__(self, query):
+        self.tasks = self.group(query(self.TASK_TAGS), self.normalize_task_tags)
+        self.areas = self.group(query(self.AREA_TAGS), self.normalize)
+
+    @staticmethod
+    def group(rows, normalize):
+        titles = {}
+        for uuid, title in rows:
+            titles.setdefault(uuid, []).append(title)
+        # items with the same tags share their normalized tags
+        normalized = {}
+        tags = {}
+        for uuid, t in titles.items():
+            t = tuple(t)
+            if t not in normalized:
+                normalized[t] = normalize(t)
+            tags[uuid] = normalized[t]
+        return tags
+
+    @staticmethod
+    def normalize(titles):
+        """Return the unique tags for the titles, in order."""
+        tags = []
+        for title in titles:
+            tag = make_tag(title)
+            if tag not in tags:
+                tags.append(tag)
+        return tuple(tags)
+
+    @classmethod
+    def normalize_task_tags(cls, titles):
+        """Return the plain tags and the keywords for the titles."""
+        tags = cls.normalize(titles)
+        keywords = cls.KEYWORDS.intersection(tags)
+        if keywords:
+            tags = tuple(tag for tag in tags if tag not in keywords)
+        return tags, frozenset(keywords)
+
+    def task_tags(self, uuid):
+        return self.tasks.get(uuid, self.NO_TASK_TAGS)
+
+    def area_tags(self, uuid):
+        return self.areas.get(uuid, ())
+
 
 class RowObject(object):
+    """
+    An exported item, populated once from a query row.
+
+    Rows are tuples with the columns in FIELDS order (extra columns at the end
+    are ignored). The loaders link the items into a tree and set their level,
+    rendering only walks that tree.
+    """
     FMT_ALL = 'all'
     FMT_PROJECT = 'project'
     FMT_AREA = 'area'
+    FORMATS = (FMT_ALL, FMT_AREA, FMT_PROJECT)
+    FILE_TMPL = '%s.org'
 
-    def __init__(self, row, con, args, level=0):
-        self.row = row
-        self.con = con
-        self.args = args
-        self.level = level
+    FIELDS = ()
+    __slots__ = ('level',)
 
-    def __getattr__(self, name):
-        return self.row[name]
+    def __init__(self, row, level=0):
+        for name, value in zip(self.FIELDS, row):
+            setattr(self, name, value)
+        self.level = level
 
     def __getitem__(self, name):
         return getattr(self, name)
 
+    def walk(self):
+        """Yield the item and everything below it, in export order."""
+        yield self
+
+    def export(self, out):
+        for item in self.walk():
+            item.print_item(out)
+
     TEMPLATE = '%s%s'
 
     def indent_(self, level):
         return "*" + "*" * level + " "
 
+    # indent_ by level, filled on first use (each class with its own indent_
+    # needs its own dict)
+    INDENTS = {}
+
     @property
     def indent(self):
-        return self.indent_(self.level)
+        try:
+            return self.INDENTS[self.level]
+        except KeyError:
+            indent = self.INDENTS[self.level] = self.indent_(self.level)
+            return indent
 
     @property
     def notes_indent(self):
@@ -84,94 +823,84 @@ class RowObject(object):
 
     URL = re.compile("\<a href=\"(?P<url>.*)?\"\>.*?\<\/a\>")
 
-    def print_notes(self):
+    def note_lines(self):
+        """Yield the lines of the notes, as plain text with links replaced by their URL."""
         notes = self.notes
         if notes.startswith("<note xml:space=\"preserve\">"):
             notes = notes[27:-7]
         for line in notes.split("\n"):
-            line = self.URL.sub(lambda m: m.group('url'), line)
-            print('%s%s' % (self.notes_indent, line))
+            yield self.URL.sub(lambda m: m.group('url'), line)
 
-    def find_and_export_items(self, klass, query):
-        c = self.con.cursor()
-        for row in c.execute(query):
-            item = klass(row, self.con, self.args, self.level + 1)
-            item.export()
+    def print_notes(self, out):
+        for line in self.note_lines():
+            out.write_line('%s%s' % (self.notes_indent, line))
 
 
 class RowObjectWithTags(RowObject):
 
     TAGS_QUERY = """
         SELECT tag.title AS title FROM TMTaskTag AS tt, TMTag AS tag
-        WHERE tt.tasks = '%s'
+        WHERE tt.tasks = ?
         AND tt.tags = tag.uuid;
     """
 
-    def __init__(self, row, con, args, level=0):
-        super().__init__(row, con, args, level)
-        self._tags = []
+    __slots__ = ('tag_list',)
 
     @property
     def tags(self):
-        if len(self._tags) == 0:
+        if len(self.tag_list) == 0:
             return ''
-        return ' :' + ':'.join(self._tags) + ":"
+        return ' :' + ':'.join(self.tag_list) + ":"
 
-    def add_tag(self, tag):
-        if tag not in self._tags:
-            self._tags.append(tag)
 
-    def load_tags_from_db(self):
-        def make_tag(title):
-            return  title.replace(' ', '_').replace('-', '_')
-
-        c = self.con.cursor()
-        for row in c.execute(self.TAGS_QUERY % self.uuid):
-            self.add_tag(make_tag(row['title']))
+class TaskObjects(RowObjectWithTags):
 
+    FIELDS = ('uuid', 'status', 'title', 'type', 'notes', 'area', 'deadline', 'startDate', 'todayIndex',
+              'checklistItemsCount', 'stopDate', 'start')
+    __slots__ = FIELDS + ('keywords',)
 
-class TaskObjects(RowObjectWithTags):
+    # the selected expression for each field, {deadline} etc. are replaced
+    # by the Schema of the database. Notes are only flagged (1 or NULL) and
+    # loaded later for the items that are exported (see QueryLoader.load_notes)
+    COLUMN_SQL = dict(deadline='{deadline} AS deadline',
+                      startDate='{startDate} AS startDate',
+                      notes="CASE WHEN notes <> '' THEN 1 END AS notes")
+    COLUMNS = ', '.join(map(COLUMN_SQL.get, FIELDS, FIELDS))
 
     task_fields = """
-        SELECT uuid, status, title, type, notes, area, deadline, startDate, todayIndex, checklistItemsCount, stopDate, start
+        SELECT %s
         FROM TMTask
-    """
+    """ % COLUMNS
 
-    def __init__(self, row, con, args, level=0):
-        super().__init__(row, con, args, level)
-        self._priority = None;
-        self._blocked = None;
-        self._idea = False;
+    # values of the type column
+    TASK = 0
+    PROJECT = 1
+    ACTIONGROUP = 2
+    TYPE = FIELDS.index('type')
 
     @property
     def org_todo_keyword(self):
-        if self._idea:
+        if "Idea" in self.keywords:
             return "IDEA"
-        if self._blocked:
+        if "Blocked" in self.keywords:
             return "BLOCKED"
         if self.start== 2:
             return "LATER"
         else:
             return "TODO"
 
+    @property
+    def priority(self):
+        if "Important" in self.keywords:
+            return 1
+        return None
+
     @property
     def org_priority_cookie(self):
-        if self._priority is not None:
-            return " [#%(_priority)s]" % self
+        if self.priority is not None:
+            return " [#%s]" % self.priority
         return ""
 
-    def add_tag(self, tag):
-        if tag == "Idea":
-            self._idea = True
-            return
-        if tag == "Important":
-            self._priority = 1
-            return
-        if tag == "Blocked":
-            self._blocked = True
-            return
-        super().add_tag(tag)
-
     def parse_db_date(self, ts_int): 
         # Things uses a bespoke numeric Date encoding 
         DAYS = 128;
@@ -187,12 +916,12 @@ class TaskObjects(RowObjectWithTags):
         return date(year, month, day)
 
 
-    def print_attributes(self):
+    def print_attributes(self, out):
         """Add all attributes (due date, start date, today, someday etc.) as tags."""
         if self.deadline:
-            print("DEADLINE: <%s>" % self.parse_db_date(self.deadline).strftime("%Y-%m-%d %a"))
+            out.write_line("DEADLINE: <%s>" % self.parse_db_date(self.deadline).strftime("%Y-%m-%d %a"))
         if self.startDate:
-            print("SCHEDULED: <%s>" % self.parse_db_date(self.startDate).strftime("%Y-%m-%d %a"))
+            out.write_line("SCHEDULED: <%s>" % self.parse_db_date(self.startDate).strftime("%Y-%m-%d %a"))
 
 
 class Area(RowObjectWithTags):
@@ -202,39 +931,34 @@ class Area(RowObjectWithTags):
 
     TAGS_QUERY = """
         SELECT tag.title AS title FROM TMAreaTag AS at, TMTag AS tag
-        WHERE at.areas = '%s'
+        WHERE at.areas = ?
         AND at.tags = tag.uuid;
     """
     AREA_TEMPLATE = "\n%(indent)s%(title)s:%(tags)s"
+    render_line = compile_template(AREA_TEMPLATE)
+
+    FIELDS = ('uuid', 'title')
+    __slots__ = FIELDS + ('tasks', 'projects')
 
-    def export(self):
+    NO_AREA = ('NULL', 'no area')
+
+    def print_item(self, out):
         logging.debug("Area: %s (%s)", self.title, self.uuid)
-        self.load_tags_from_db()
-        next_level = 1
-        print(self.AREA_TEMPLATE % self)
-
-        c = self.con.cursor()
-
-        if self.uuid == 'NULL':
-            inbox = Project(dict(uuid='NULL', title='Inbox',
-                                 deadline=None, startDate=None, stopDate=None, todayIndex=None, notes=None, start=None),
-                            self.con, self.args, self.level + 1, self)
-            inbox.export()
-            query = Project.PROJECTS_WITHOUT_AREA
-        else:
-            self.find_and_export_items(Task, Task.TASKS_IN_AREA_WITHOUT_PROJECT % self.uuid)
-            query = Project.PROJECTS_IN_AREA % self.uuid
+        out.write_line(self.render_line())
 
-        for row in c.execute(query):
-            p = Project(row, self.con, self.args, next_level, self)
-            p.export()
+    def walk(self):
+        yield self
+        for task in self.tasks:
+            yield from task.walk()
+        for project in self.projects:
+            yield from project.walk()
 
 
 
 class Project(TaskObjects):
     PROJECTS_IN_AREA = TaskObjects.task_fields + """
         WHERE type=1
-        AND area="%s"
+        AND area = ?
         AND trashed = 0
         AND status < 2 -- not canceled
         ORDER BY "index";
@@ -248,24 +972,27 @@ class Project(TaskObjects):
     """
 
     PROJECT_TEMPLATE = "\n%(indent)s%(org_todo_keyword)s%(org_priority_cookie)s %(title)s%(tags)s"
+    render_line = compile_template(PROJECT_TEMPLATE)
 
-    def __init__(self, row, con, args, level, area):
-        super().__init__(row, con, args, level)
-        self.area = area
+    __slots__ = ('items',)
 
-    def export(self):
+    @classmethod
+    def inbox(cls):
+        values = dict(uuid='NULL', title='Inbox', type=cls.PROJECT)
+        return cls([values.get(name) for name in cls.FIELDS])
+
+    def print_item(self, out):
         logging.debug("Project: %s (%s)", self.title, self.uuid)
-        self.load_tags_from_db()
-        print(self.PROJECT_TEMPLATE % self)
-        self.print_attributes()
+        out.write_line(self.render_line())
+        self.print_attributes(out)
 
         if self.notes:
-            self.print_notes()
+            self.print_notes(out)
 
-        if self.uuid == 'NULL':
-            self.find_and_export_items(Task, Task.TASKS_IN_INBOX)
-        else:
-            self.find_and_export_items(Task, Task.TASKS_IN_PROJECT % self.uuid)
+    def walk(self):
+        yield self
+        for item in self.items:
+            yield from item.walk()
 
 
 
@@ -273,14 +1000,14 @@ class Task(TaskObjects):
 
     TASKS_IN_PROJECT = TaskObjects.task_fields + """
         WHERE type != 1 -- find tasks and action groups
-        AND project="%s"
+        AND project = ?
         AND trashed = 0
         AND status < 2 -- whatever "1" means
         ORDER BY type, "index"; -- tasks without headers come first
     """
     TASKS_IN_AREA_WITHOUT_PROJECT = TaskObjects.task_fields + """
         WHERE type != 1 -- find tasks and action groups
-        AND area="%s"
+        AND area = ?
         AND project is NULL
         AND trashed = 0
         AND status < 2 -- whatever "1" means
@@ -290,51 +1017,87 @@ class Task(TaskObjects):
         WHERE type != 1 -- find tasks and action groups
         AND project IS NULL
         AND area IS NULL
-        AND heading IS NULL
+        AND {heading} IS NULL
         AND trashed = 0
         AND status < 2 -- whatever "1" means
         ORDER BY "index";
     """
     TASKS_IN_ACTION_GROUPS = TaskObjects.task_fields + """
         WHERE type = 0
-        AND heading="%s"
+        AND {heading} = ?
         AND trashed = 0
         AND status < 2 -- whatever "1" means
         ORDER BY "index";
     """
-    ACTIONGROUP = 2
     TASK_TEMPLATE = '%(indent)s%(org_todo_keyword)s%(org_priority_cookie)s %(title)s%(tags)s'
-    ACTIONGROUP_TEMPLATE = '%(indent)sTODO %(title)s:'
+    render_line = compile_template(TASK_TEMPLATE)
 
+    __slots__ = ('checklist',)
 
-    def export(self):
+    @staticmethod
+    def from_row(row):
+        """Return a Task, or a Heading for action group rows."""
+        if row[TaskObjects.TYPE] == TaskObjects.ACTIONGROUP:
+            return Heading(row)
+        return Task(row)
+
+    def print_item(self, out):
         logging.debug("Task: %s (%s) Level: %s Status: %s Type: %s, Start: %s Deadline: %s StartDate: %s", self.title, self.uuid, self.level, self.status, self.type, self.start, self.deadline, self.startDate)
-        self.load_tags_from_db()
-        if self.type == self.ACTIONGROUP:
-            # process action group (which have no notes!)
-            print(self.ACTIONGROUP_TEMPLATE % self)
-            self.find_and_export_items(Task, Task.TASKS_IN_ACTION_GROUPS % self.uuid)
-        else:
-            print(self.TASK_TEMPLATE % self)
-            self.print_attributes()
-            if self.notes:
-                self.print_notes()
+        out.write_line(self.render_line())
+        self.print_attributes(out)
+        if self.notes:
+            self.print_notes(out)
+
+    def walk(self):
+        yield self
+        for item in self.checklist:
+            yield from item.walk()
+
+
+class Heading(TaskObjects):
+    """An action group (heading) in a project, which has tasks but no notes."""
 
-            if self.checkListItemsCount:
-                self.find_and_export_items(CheckListItem, CheckListItem.items_of_task % self.uuid)
+    ACTIONGROUP_TEMPLATE = '%(indent)sTODO %(title)s:'
+    render_line = compile_template(ACTIONGROUP_TEMPLATE)
+
+    __slots__ = ('tasks',)
+
+    def print_item(self, out):
+        logging.debug("Heading: %s (%s) Level: %s", self.title, self.uuid, self.level)
+        out.write_line(self.render_line())
+
+    def walk(self):
+        yield self
+        for task in self.tasks:
+            yield from task.walk()
 
 
 class CheckListItem(RowObject):
     items_of_task = """
         SELECT uuid, title, status
         FROM TMChecklistItem
-        WHERE task = '%s'
+        WHERE task = ?
         ORDER BY "index"
     """
+    ALL_ITEMS = """
+        SELECT uuid, title, status, task
+        FROM TMChecklistItem
+        ORDER BY task, "index";
+    """
+
+    FIELDS = ('uuid', 'title', 'status')
+    __slots__ = FIELDS
+
+    @classmethod
+    def prefetch(cls, query):
+        """Read all checklist items in one scan and group them by task uuid."""
+        return {task: [cls(row) for row in rows] for task, rows in groupby(query(cls.ALL_ITEMS), itemgetter(3))}
 
     def indent_(self, level):
         return ""
 
+    INDENTS = {}
+
     @property
     def checkbox_status(self): 
         if self.status > 0:
@@ -343,10 +1106,1514 @@ class CheckListItem(RowObject):
             return " "
 
     CHECKLIST_ITEM_TEMPLATE = '%(indent)s- [%(checkbox_status)s] %(title)s%(tags)s'
+    render_line = compile_template(CHECKLIST_ITEM_TEMPLATE)
+
+    def print_item(self, out):
+        out.write_line(self.render_line())
+
+
+class Emitter(object):
+    """
+    Render the items of one traversal of the loaded model in one output format.
+
+    export() hands every item to emit(item, out), which writes its lines to
+    the sink out. begin(out) and end(out) are called at the start and end of
+    each output file. Choosing an emitter does not change what is queried.
+    """
+
+    NAME = None
+    FILE_TMPL = None
 
-    def export(self):
-        print(self.CHECKLIST_ITEM_TEMPLATE % self)
+    def begin(self, out):
+        pass
 
+    def emit(self, item, out):
+        raise NotImplementedError
+
+    def end(self, out):
+        pass
+
+
+class OrgEmitter(Emitter):
+    """Render items as org-mode, with the templates of the item classes."""
+
+    NAME = 'org'
+    FILE_TMPL = RowObject.FILE_TMPL
+
+    def emit(self, item, out):
+        item.print_item(out)
+
+
+class TaskPaperEmitter(Emitter):
+    """
+    Render items as TaskPaper: areas, projects and headings are "title:"
+    lines, tasks and checklist items "- title" lines, nested with tabs.
+    Tags, the deadline and the start (today, a start date or someday) are
+    @tags.
+    """
+
+    NAME = 'taskpaper'
+    FILE_TMPL = '%s.taskpaper'
+
+    AREA_TEMPLATE = '\n%s:%s'
+    PROJECT_TEMPLATE = '\n%s%s:%s'
+    TASK_TEMPLATE = '%s- %s%s'
+    HEADING_TEMPLATE = '%s%s:'
+    CHECKLIST_ITEM_TEMPLATE = '%s- %s%s'
+
+    def __init__(self):
+        self.indents = {}
+        self.renderers = {
+            Area: self.area,
+            Project: self.project,
+            Task: self.task,
+            Heading: self.heading,
+            CheckListItem: self.checklist_item,
+        }
+
+    def emit(self, item, out):
+        self.renderers[type(item)](item, out)
+
+    def indent(self, level):
+        try:
+            return self.indents[level]
+        except KeyError:
+            indent = self.indents[level] = '\t' * level
+            return indent
+
+    @staticmethod
+    def tags(tags):
+        return ''.join(' @' + tag for tag in tags)
+
+    def task_tags(self, item):
+        """Return the @tags of a project or task, with its keywords, deadline and start."""
+        tags = list(item.tag_list)
+        tags.extend(sorted(item.keywords))
+        if item.deadline:
+            tags.append('due(%s)' % item.parse_db_date(item.deadline).isoformat())
+        if item.startDate:
+            if item.todayIndex:
+                tags.append('today')
+            else:
+                tags.append('startDate(%s)' % item.parse_db_date(item.startDate).isoformat())
+        elif item.start == 2:
+            tags.append('someday')
+        return self.tags(tags)
+
+    def print_notes(self, item, out):
+        indent = self.indent(item.level + 1)
+        for line in item.note_lines():
+            out.write_line(indent + line)
+
+    def area(self, item, out):
+        out.write_line(self.AREA_TEMPLATE % (item.title, self.tags(item.tag_list)))
+
+    def project(self, item, out):
+        out.write_line(self.PROJECT_TEMPLATE % (self.indent(item.level), item.title, self.task_tags(item)))
+        if item.notes:
+            self.print_notes(item, out)
+
+    def task(self, item, out):
+        out.write_line(self.TASK_TEMPLATE % (self.indent(item.level), item.title, self.task_tags(item)))
+        if item.notes:
+            self.print_notes(item, out)
+
+    def heading(self, item, out):
+        out.write_line(self.HEADING_TEMPLATE % (self.indent(item.level), item.title))
+
+    def checklist_item(self, item, out):
+        out.write_line(self.CHECKLIST_ITEM_TEMPLATE % (self.indent(item.level), item.title,
+                                                       ' @done' if item.status > 0 else ''))
+
+
+class ItemRecords(object):
+    """
+    Build a dict of the fields of each item, for the emitters of structured
+    formats (JSON, OPML, SQLite): its type, uuid, the uuid of its parent,
+    tags and ISO dates, and the notes as plain text.
+
+    The items must be passed in export order. Only the uuids of the open
+    parents are kept. The no area area and the Inbox have the type no_area
+    or inbox and the uuid None.
+    """
+
+    TYPES = {
+        Area: 'area',
+        Project: 'project',
+        Task: 'task',
+        Heading: 'heading',
+        CheckListItem: 'checklist_item',
+    }
+    # the types of the pseudo area and project of items without one (see
+    # Area.NO_AREA and Project.inbox), which have the uuid 'NULL'
+    PSEUDO_TYPES = {
+        Area: 'no_area',
+        Project: 'inbox',
+    }
+    PSEUDO_UUID = 'NULL'
+
+    def __init__(self):
+        # uuids of the parents of the current item, by level
+        self.parents = []
+
+    @staticmethod
+    def date(item, value):
+        return item.parse_db_date(value).isoformat() if value else None
+
+    def record(self, item):
+        del self.parents[item.level:]
+        if item.uuid == self.PSEUDO_UUID:
+            record = dict(type=self.PSEUDO_TYPES[type(item)], uuid=None)
+        else:
+            record = dict(type=self.TYPES[type(item)], uuid=item.uuid)
+        record.update(parent=self.parents[-1] if self.parents else None, title=item.title)
+        self.parents.append(record['uuid'])
+        if isinstance(item, TaskObjects):
+            # NULL is 0, as in the columnar store
+            record.update(status=item.status or 0,
+                          tags=list(item.tag_list),
+                          keywords=sorted(item.keywords),
+                          deadline=self.date(item, item.deadline),
+                          startDate=self.date(item, item.startDate),
+                          start=item.start or 0,
+                          today=bool(item.todayIndex),
+                          notes='\n'.join(item.note_lines()) if item.notes else None)
+        elif isinstance(item, Area):
+            record.update(tags=list(item.tag_list))
+        else:
+            record.update(status=item.status)
+        return record
+
+
+class NDJSONEmitter(Emitter):
+    """
+    Render every area, project, heading, task and checklist item as one JSON
+    object per line (newline-delimited JSON), with the fields of ItemRecords.
+
+    Only the uuids of the open parents are kept, so with --engine stream the
+    export runs in constant memory, and lines are written while the database
+    is read (in chunks of OutputSink.BUFFER_SIZE), e.g. into jq.
+
+    The no area area and the Inbox are not written, their items have no
+    parent.
+    """
+
+    NAME = 'ndjson'
+    FILE_TMPL = '%s.ndjson'
+
+    def __init__(self):
+        self.records = ItemRecords()
+
+    def emit(self, item, out):
+        record = self.records.record(item)
+        if record['uuid'] is not None:  # not a pseudo area or project
+            out.write_line(json.dumps(record, ensure_ascii=False))
+
+
+class JSONEmitter(NDJSONEmitter):
+    """
+    Render the records of NDJSONEmitter as one JSON array per file, still
+    written one record per line while the export runs.
+    """
+
+    NAME = 'json'
+    FILE_TMPL = '%s.json'
+
+    def __init__(self):
+        super().__init__()
+        # the last record of each file, written with a comma once the next follows
+        self.pending = {}
+
+    def begin(self, out):
+        out.write_line('[')
+
+    def emit(self, item, out):
+        record = self.records.record(item)
+        if record['uuid'] is None:  # a pseudo area or project
+            return
+        record = json.dumps(record, ensure_ascii=False)
+        pending = self.pending.get(out)
+        if pending is not None:
+            out.write_line(pending + ',')
+        self.pending[out] = record
+
+    def end(self, out):
+        pending = self.pending.pop(out, None)
+        if pending is not None:
+            out.write_line(pending)
+        out.write_line(']')
+
+
+class ICalendarEmitter(Emitter):
+    """
+    Render every project and task with a deadline or start date as a VTODO
+    of an iCalendar file (RFC 5545), e.g. for a calendar subscription. The
+    deadline is the DUE date, the start date the DTSTART. The UID is derived
+    from the uuid, so calendars update the same entry on the next export.
+
+    Lines end with CRLF and are folded after 75 octets. DTSTAMP is the UTC day
+    of the export (not the time), so with FileLayout the files of unchanged
+    items are not rewritten by exports during the same day.
+    """
+
+    NAME = 'ics'
+    FILE_TMPL = '%s.ics'
+
+    LINE_OCTETS = 75
+    # OutputSink joins lines with LF, CR completes the line break
+    CRLF = '\r'
+    ESCAPES = str.maketrans({'\\': '\\\\', ';': '\\;', ',': '\\,', '\n': '\\n'})
+    UID = '%s@things3-export'
+    URL = 'things:///show?id=%s'
+
+    BEGIN = ('BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//things3-export//Things 3 export//EN',
+             'CALSCALE:GREGORIAN', 'X-WR-CALNAME:Things')
+
+    def __init__(self):
+        self.stamp = datetime.now(timezone.utc).strftime('DTSTAMP:%Y%m%dT000000Z')
+
+    def write_line(self, out, line):
+        """Write line folded into lines of at most LINE_OCTETS octets, without splitting a character."""
+        if len(line) > self.LINE_OCTETS // 4:  # shorter lines fit even with 4 octets per character
+            data = line.encode('utf-8')
+            if len(data) > self.LINE_OCTETS:
+                parts = []
+                start = 0
+                limit = self.LINE_OCTETS
+                while len(data) - start > limit:
+                    end = start + limit
+                    while data[end] & 0xC0 == 0x80:  # UTF-8 continuation byte
+                        end -= 1
+                    parts.append(data[start:end].decode('utf-8'))
+                    start = end
+                    limit = self.LINE_OCTETS - 1  # the continuation lines start with a space
+                parts.append(data[start:].decode('utf-8'))
+                line = (self.CRLF + '\n ').join(parts)
+        out.write_line(line + self.CRLF)
+
+    def text(self, value):
+        # CR would end the content line
+        return value.replace('\r\n', '\n').replace('\r', '\n').translate(self.ESCAPES)
+
+    def begin(self, out):
+        for line in self.BEGIN:
+            self.write_line(out, line)
+
+    def emit(self, item, out):
+        if not isinstance(item, (Project, Task)) or not (item.deadline or item.startDate):
+            return
+        due = item.parse_db_date(item.deadline) if item.deadline else None
+        start = item.parse_db_date(item.startDate) if item.startDate else None
+        lines = ['BEGIN:VTODO', 'UID:' + self.UID % item.uuid, self.stamp,
+                 'SUMMARY:' + self.text(item.title or '')]
+        if start and not (due and start > due):
+            lines.append(start.strftime('DTSTART;VALUE=DATE:%Y%m%d'))
+        if due:
+            lines.append(due.strftime('DUE;VALUE=DATE:%Y%m%d'))
+        lines.append('STATUS:NEEDS-ACTION')
+        if item.priority is not None:
+            lines.append('PRIORITY:%s' % item.priority)
+        tags = list(item.tag_list) + sorted(item.keywords)
+        if tags:
+            lines.append('CATEGORIES:' + ','.join(map(self.text, tags)))
+        if item.notes:
+            lines.append('DESCRIPTION:' + self.text('\n'.join(item.note_lines())))
+        lines.append('URL:' + self.URL % item.uuid)
+        lines.append('END:VTODO')
+        for line in lines:
+            self.write_line(out, line)
+
+    def end(self, out):
+        self.write_line(out, 'END:VCALENDAR')
+
+
+class OPMLEmitter(Emitter):
+    """
+    Render the tree as nested <outline> elements of an OPML 2.0 document,
+    for outliners. The title is the text attribute, the notes are _note and
+    done checklist items have _status="checked" (as OmniOutliner writes
+    them), the other fields of ItemRecords are attributes of their own.
+
+    The document is written with an XMLGenerator while the items are
+    emitted: only the depths of the open outlines are kept, and the lines it
+    has completed are passed on to the sink after each item.
+    """
+
+    NAME = 'opml'
+    FILE_TMPL = '%s.opml'
+
+    INDENT = '  '
+
+    def __init__(self):
+        self.records = ItemRecords()
+        # per sink: the generator, its buffer and the levels of the open outlines
+        self.documents = {}
+
+    def begin(self, out):
+        buffer = io.StringIO()
+        generator = XMLGenerator(buffer, 'utf-8', short_empty_elements=True)
+        self.documents[out] = (generator, buffer, [])
+        title = os.path.splitext(os.path.basename(out.path))[0] if out.path else 'Things'
+        generator.startDocument()
+        generator.startElement('opml', {'version': '2.0'})
+        self.indent(generator, 1)
+        generator.startElement('head', {})
+        self.indent(generator, 2)
+        generator.startElement('title', {})
+        generator.characters(title)
+        generator.endElement('title')
+        self.indent(generator, 1)
+        generator.endElement('head')
+        self.indent(generator, 1)
+        generator.startElement('body', {})
+
+    def indent(self, generator, depth):
+        generator.ignorableWhitespace('\n' + self.INDENT * depth)
+
+    def attributes(self, item):
+        record = self.records.record(item)
+        attributes = {'text': record['title'] or '', 'type': record['type']}
+        tags = record.get('tags', []) + record.get('keywords', [])
+        if tags:
+            attributes['tags'] = ','.join(tags)
+        for name in ('deadline', 'startDate'):
+            if record.get(name):
+                attributes[name] = record[name]
+        if record.get('today'):
+            attributes['today'] = 'true'
+        if record.get('start') == 2:
+            attributes['someday'] = 'true'
+        if record.get('notes'):
+            attributes['_note'] = record['notes']
+        if isinstance(item, CheckListItem) and item.status:
+            attributes['_status'] = 'checked'
+        return attributes
+
+    def close_outlines(self, generator, levels, level):
+        """End the open outlines at level and below it."""
+        # the last outline was started by the last item, it ends as <outline .../>
+        leaf = True
+        while levels and levels[-1] >= level:
+            levels.pop()
+            if not leaf:
+                self.indent(generator, len(levels) + 2)
+            generator.endElement('outline')
+            leaf = False
+
+    def emit(self, item, out):
+        generator, buffer, levels = self.documents[out]
+        self.close_outlines(generator, levels, item.level)
+        self.indent(generator, len(levels) + 2)
+        generator.startElement('outline', self.attributes(item))
+        levels.append(item.level)
+        self.write_lines(buffer, out)
+
+    def write_lines(self, buffer, out, final=False):
+        """Pass the completed lines of the buffer (all lines if final) on to out."""
+        text = buffer.getvalue()
+        if final:
+            rest = ''
+        else:
+            text, _, rest = text.rpartition('\n')
+        buffer.seek(0)
+        buffer.truncate()
+        buffer.write(rest)
+        if text:
+            for line in text.split('\n'):
+                out.write_line(line)
+
+    def end(self, out):
+        generator, buffer, levels = self.documents.pop(out)
+        self.close_outlines(generator, levels, 0)
+        self.indent(generator, 1)
+        generator.endElement('body')
+        self.indent(generator, 0)
+        generator.endElement('opml')
+        generator.endDocument()
+        self.write_lines(buffer, out, final=True)
+
+
+class CSVEmitter(Emitter):
+    """
+    Write one row per exported task into a CSV file, for spreadsheets.
+
+    This does not render the loaded items: the rows come from a single joined
+    query (TASKS), which selects the same tasks as the loaders and decodes the
+    dates, joins the tags and counts the checklist items in SQL. They are
+    written with writerows() in chunks of CHUNK_ROWS, so there is almost no
+    work per row in Python (see export_table).
+    """
+
+    NAME = 'csv'
+    FILE_TMPL = '%s.csv'
+    DIALECT = 'excel'
+    # with a BOM, so spreadsheets recognize the file as UTF-8
+    ENCODING = 'utf-8-sig'
+
+    CHUNK_ROWS = 10000
+
+    HEADER = ('uuid', 'area', 'project', 'heading', 'title', 'status', 'deadline', 'start_date', 'tags',
+              'checklist_items', 'checklist_items_done', 'notes_length')
+
+    # a packed date (see TaskObjects.parse_db_date) as YYYY-MM-DD
+    ISO_DATE = "CASE WHEN %s THEN printf('%%04d-%%02d-%%02d', %s >> 16, (%s >> 12) & 15, (%s >> 7) & 31) END"
+
+    TASKS = """
+        WITH
+        -- not by index_TMTask_type (+type), reading most of the table through
+        -- an index is slower than scanning it
+        task AS (
+            SELECT *, {deadline} AS due_date, {startDate} AS start_date FROM TMTask
+            WHERE +type = 0 AND trashed = 0 AND status < 2
+        )
+        SELECT t.uuid, IFNULL(pa.title, a.title), p.title, h.title, t.title, t.status,
+               {deadline_date}, {start_date},
+               (SELECT group_concat(tag.title, ', ') FROM TMTaskTag AS tt JOIN TMTag AS tag
+                ON tag.uuid = tt.tags WHERE tt.tasks = t.uuid),
+               IFNULL(t.checklistItemsCount, 0),
+               CASE WHEN t.checklistItemsCount
+                    THEN (SELECT count(*) FROM TMChecklistItem WHERE task = t.uuid AND status > 0)
+                    ELSE 0 END,
+               -- without the <note> wrapper
+               CASE WHEN t.notes LIKE '<note xml:space="preserve">%' THEN length(t.notes) - 34
+                    ELSE IFNULL(length(t.notes), 0) END
+        FROM task AS t
+        LEFT JOIN TMTask AS h ON h.uuid = t.{heading} AND h.type = 2 AND h.trashed = 0 AND h.status < 2
+        LEFT JOIN TMTask AS p ON p.uuid = IFNULL(t.project, h.project)
+                              AND p.type = 1 AND p.trashed = 0 AND p.status < 2
+        LEFT JOIN TMArea AS pa ON pa.uuid = p.area
+        LEFT JOIN TMArea AS a ON a.uuid = t.area AND t.project IS NULL AND t.{heading} IS NULL
+        -- in an exported project (or its heading), an area or the inbox
+        WHERE CASE WHEN t.project IS NOT NULL OR t.{heading} IS NOT NULL
+                   THEN p.uuid IS NOT NULL AND (p.area IS NULL OR pa.uuid IS NOT NULL)
+                   WHEN t.area IS NOT NULL THEN a.uuid IS NOT NULL
+                   ELSE 1 END
+        -- export order: tasks in the area before its projects, in a project
+        -- the tasks without a heading first
+        ORDER BY IFNULL(pa."index", a."index"), IFNULL(pa.uuid, a.uuid), a.uuid IS NULL,
+                 p."index", p.uuid, h."index", h.uuid, t."index", t.uuid;
+    """.replace('{deadline_date}', ISO_DATE % (('t.due_date',) * 4)).replace(
+        '{start_date}', ISO_DATE % (('t.start_date',) * 4))
+
+    def write_table(self, cursor, file):
+        writer = csv.writer(file, dialect=self.DIALECT)
+        writer.writerow(self.HEADER)
+        rows = 0
+        while True:
+            chunk = cursor.fetchmany(self.CHUNK_ROWS)
+            if not chunk:
+                return rows
+            writer.writerows(chunk)
+            rows += len(chunk)
+
+
+class TSVEmitter(CSVEmitter):
+    """Write the rows of CSVEmitter tab-separated."""
+
+    NAME = 'tsv'
+    FILE_TMPL = '%s.tsv'
+    DIALECT = 'excel-tab'
+
+
+class SQLiteEmitter(Emitter):
+    """
+    Write the records of ItemRecords into a new, normalized SQLite database
+    (see DatabaseSink): one table each for areas, projects, headings, tasks
+    and checklist items, the tags in a join table, dates as ISO text and the
+    notes as plain text. The search table is an FTS5 index over the titles
+    and notes of all items, e.g.
+
+        SELECT type, uuid, title FROM search WHERE search MATCH 'invoice';
+
+    Rows are inserted with executemany() in batches of BATCH_ROWS, all in one
+    transaction, and the indexes are created after the last insert. The "no
+    area" area and the Inbox are not stored, their items have no area or
+    project. position is the position of the item in the export.
+
+    A task that is in a heading and also has a project or area is exported
+    in both lists, it is stored once (the first time) with its checklist.
+    """
+
+    NAME = 'sqlite'
+    FILE_TMPL = '%s.sqlite'
+
+    BATCH_ROWS = 10000
+
+    SCHEMA = """
+        CREATE TABLE area (uuid TEXT PRIMARY KEY, title TEXT, position INTEGER);
+        CREATE TABLE project (uuid TEXT PRIMARY KEY, area TEXT REFERENCES area, title TEXT, status INTEGER,
+                              start INTEGER, deadline TEXT, start_date TEXT, today INTEGER, notes TEXT,
+                              position INTEGER);
+        CREATE TABLE heading (uuid TEXT PRIMARY KEY, project TEXT REFERENCES project, title TEXT,
+                              position INTEGER);
+        CREATE TABLE task (uuid TEXT PRIMARY KEY, area TEXT REFERENCES area, project TEXT REFERENCES project,
+                           heading TEXT REFERENCES heading, title TEXT, status INTEGER, start INTEGER,
+                           deadline TEXT, start_date TEXT, today INTEGER, notes TEXT, position INTEGER);
+        CREATE TABLE checklist_item (uuid TEXT PRIMARY KEY, task TEXT REFERENCES task, title TEXT,
+                                     status INTEGER, position INTEGER);
+        CREATE TABLE tag (id INTEGER PRIMARY KEY, title TEXT UNIQUE);
+        -- tags of areas, projects and tasks, including the keywords (Important, Idea, Blocked)
+        CREATE TABLE item_tag (item TEXT NOT NULL, tag INTEGER NOT NULL REFERENCES tag);
+    """
+    INDEXES = """
+        CREATE INDEX project_area ON project (area, position);
+        CREATE INDEX project_deadline ON project (deadline) WHERE deadline IS NOT NULL;
+        CREATE INDEX heading_project ON heading (project, position);
+        CREATE INDEX task_area ON task (area, position);
+        CREATE INDEX task_project ON task (project, position);
+        CREATE INDEX task_heading ON task (heading, position);
+        CREATE INDEX task_deadline ON task (deadline) WHERE deadline IS NOT NULL;
+        CREATE INDEX task_start_date ON task (start_date) WHERE start_date IS NOT NULL;
+        CREATE INDEX checklist_item_task ON checklist_item (task, position);
+        CREATE INDEX item_tag_item ON item_tag (item);
+        CREATE INDEX item_tag_tag ON item_tag (tag);
+    """
+    SEARCH = """
+        CREATE VIRTUAL TABLE search USING fts5(type UNINDEXED, uuid UNINDEXED, title, notes);
+        INSERT INTO search SELECT 'area', uuid, title, NULL FROM area;
+        INSERT INTO search SELECT 'project', uuid, title, notes FROM project;
+        INSERT INTO search SELECT 'heading', uuid, title, NULL FROM heading;
+        INSERT INTO search SELECT 'task', uuid, title, notes FROM task;
+        INSERT INTO search SELECT 'checklist_item', uuid, title, NULL FROM checklist_item;
+    """
+
+    INSERTS = {
+        'area': 'INSERT INTO area VALUES (?, ?, ?)',
+        'project': 'INSERT INTO project VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        'heading': 'INSERT INTO heading VALUES (?, ?, ?, ?)',
+        'task': 'INSERT INTO task VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        'checklist_item': 'INSERT INTO checklist_item VALUES (?, ?, ?, ?, ?)',
+        'item_tag': 'INSERT INTO item_tag VALUES (?, ?)',
+    }
+
+    def __init__(self):
+        self.records = ItemRecords()
+        # the areas, projects and headings the current item is in, by level
+        self.ancestors = []
+        self.rows = {table: [] for table in self.INSERTS}
+        self.pending = 0
+        self.position = 0
+        self.tag_ids = {}
+        # uuids of the tasks stored so far, and the level of the repeated
+        # task whose checklist items are skipped
+        self.task_uuids = set()
+        self.skip_level = None
+
+    def begin(self, out):
+        out.con.executescript(self.SCHEMA)
+        out.con.execute('BEGIN')
+
+    def ancestor(self, cls):
+        """Return the uuid of the area, project or heading the current item is in."""
+        for item in self.ancestors:
+            if type(item) is cls and item.uuid != ItemRecords.PSEUDO_UUID:
+                return item.uuid
+        return None
+
+    def tag_id(self, title):
+        try:
+            return self.tag_ids[title]
+        except KeyError:
+            id = self.tag_ids[title] = len(self.tag_ids) + 1
+            return id
+
+    def emit(self, item, out):
+        if self.skip_level is not None:
+            if item.level > self.skip_level:
+                return
+            self.skip_level = None
+        if isinstance(item, Task):
+            if item.uuid in self.task_uuids:
+                self.skip_level = item.level
+                return
+            self.task_uuids.add(item.uuid)
+        del self.ancestors[item.level:]
+        self.ancestors.append(item)
+        record = self.records.record(item)
+        if record['uuid'] is None:  # a pseudo area or project
+            return
+        self.position += 1
+        if isinstance(item, Area):
+            row = (item.uuid, item.title, self.position)
+        elif isinstance(item, Project):
+            row = (item.uuid, self.ancestor(Area), item.title, record['status'], record['start'],
+                   record['deadline'], record['startDate'], int(record['today']), record['notes'], self.position)
+        elif isinstance(item, Heading):
+            row = (item.uuid, self.ancestor(Project), item.title, self.position)
+        elif isinstance(item, Task):
+            row = (item.uuid, self.ancestor(Area), self.ancestor(Project), self.ancestor(Heading), item.title,
+                   record['status'], record['start'], record['deadline'], record['startDate'],
+                   int(record['today']), record['notes'], self.position)
+        else:
+            row = (item.uuid, record['parent'], item.title, record['status'], self.position)
+        self.rows[record['type']].append(row)
+        for tag in record.get('tags', []) + record.get('keywords', []):
+            self.rows['item_tag'].append((item.uuid, self.tag_id(tag)))
+        self.pending += 1
+        if self.pending >= self.BATCH_ROWS:
+            self.insert(out.con)
+
+    def insert(self, con):
+        for table, rows in self.rows.items():
+            if rows:
+                con.executemany(self.INSERTS[table], rows)
+                rows.clear()
+        self.pending = 0
+
+    def end(self, out):
+        self.insert(out.con)
+        out.con.executemany('INSERT INTO tag VALUES (?, ?)', ((id, title) for title, id in self.tag_ids.items()))
+        out.con.execute('COMMIT')
+        out.con.executescript(self.INDEXES)
+        try:
+            out.con.executescript(self.SEARCH)
+        except sqlite3.OperationalError as e:
+            logging.warning("no full-text search table: %s", e)  # SQLite without FTS5
+
+
+class DatabaseSink(object):
+    """
+    The sink of SQLiteEmitter, which writes into a database instead of lines.
+
+    The database is created next to path as a temporary file without a
+    journal, and replaces path when it is complete.
+    """
+
+    def __init__(self, path, emitter):
+        if not os.path.splitext(path)[1]:
+            path = emitter.FILE_TMPL % path
+        self.path = path
+        self.emitter = emitter
+        self.started = time.perf_counter()
+        fd, self.temp = make_temp_file(os.path.dirname(path) or '.')
+        os.close(fd)
+        self.con = sqlite3.connect(self.temp, isolation_level=None)
+        try:
+            self.con.execute('PRAGMA journal_mode = OFF')
+            self.con.execute('PRAGMA synchronous = OFF')
+            self.emitter.begin(self)
+        except BaseException:
+            self.abort()
+            raise
+
+    def write_item(self, item):
+        self.emitter.emit(item, self)
+
+    def close(self):
+        try:
+            self.emitter.end(self)
+            self.con.close()
+        except BaseException:
+            self.abort()
+            raise
+        os.replace(self.temp, self.path)
+        logging.info("%s: %s items written in %.3f s", self.path, self.emitter.position,
+                     time.perf_counter() - self.started)
+
+    def abort(self):
+        """Remove the unfinished database of a failed export."""
+        self.con.close()
+        os.unlink(self.temp)
+
+
+EMITTERS = {
+    OrgEmitter.NAME: OrgEmitter,
+    TaskPaperEmitter.NAME: TaskPaperEmitter,
+    NDJSONEmitter.NAME: NDJSONEmitter,
+    JSONEmitter.NAME: JSONEmitter,
+    ICalendarEmitter.NAME: ICalendarEmitter,
+    OPMLEmitter.NAME: OPMLEmitter,
+    CSVEmitter.NAME: CSVEmitter,
+    TSVEmitter.NAME: TSVEmitter,
+    SQLiteEmitter.NAME: SQLiteEmitter,
+}
+
+
+class QueryLoader(object):
+    """Fetch each level of the tree with its own query."""
+
+    STREAMING = False
+
+    NOTES = """
+        SELECT uuid, notes FROM TMTask
+        WHERE uuid IN (%s);
+    """
+    # uuids per notes query, below SQLite's default limit of 999 parameters
+    NOTES_BATCH = 500
+
+    # indexes for the per-level queries, which are only built on snapshots
+    # (see create_indexes): name, table and columns, the query served and the
+    # parents it runs for. Range conditions (status < 2, type != 1) come after
+    # the ORDER BY columns, so the rows are read in order without a sort. Tags
+    # have no index: TAGS_QUERY returns them in rowid order, which only
+    # index_TMTaskTag_tasks keeps
+    INDEXES = (
+        ('export_task_project', 'TMTask (project, trashed, type, "index", status)',
+         Task.TASKS_IN_PROJECT, 'SELECT uuid FROM TMTask WHERE type = 1 AND trashed = 0 AND status < 2;'),
+        ('export_task_heading', 'TMTask ({heading}, trashed, "index", status, type)',
+         Task.TASKS_IN_ACTION_GROUPS, 'SELECT uuid FROM TMTask WHERE type = 2 AND trashed = 0 AND status < 2;'),
+        ('export_task_area', 'TMTask (area, project, trashed, type, "index", status)',
+         Task.TASKS_IN_AREA_WITHOUT_PROJECT, 'SELECT uuid FROM TMArea;'),
+        ('export_checklist_items', 'TMChecklistItem (task, "index")',
+         CheckListItem.items_of_task,
+         'SELECT uuid FROM TMTask WHERE checklistItemsCount AND trashed = 0 AND status < 2;'),
+    )
+
+    def __init__(self, con):
+        self.con = con
+        self.schema = Schema.probe(con)
+        self.queries = 0
+        self.statements = set()
+        # query -> (calls, seconds), only recorded if set to a dict (see explain)
+        self.profile = None
+
+    def query(self, query, params=()):
+        self.queries += 1
+        self.statements.add(query)
+        if self.profile is None:
+            return self.con.execute(self.schema.sql(query), params)
+        # fetch all rows, so the time includes stepping through the result
+        started = time.perf_counter()
+        rows = self.con.execute(self.schema.sql(query), params).fetchall()
+        calls, seconds = self.profile.get(query, (0, 0.0))
+        self.profile[query] = (calls + 1, seconds + time.perf_counter() - started)
+        return rows
+
+    @property
+    def statement_cache_hit_rate(self):
+        """
+        Share of queries that reused a prepared statement.
+
+        sqlite3 does not expose its statement cache, but every query constant
+        is parametrized and the cache holds all of them, so each statement is
+        only prepared the first time it is executed.
+        """
+        if not self.queries:
+            return 0.0
+        return 1 - len(self.statements) / self.queries
+
+    def load(self, notes=True):
+        """
+        Return all areas, with their projects, tasks and checklists linked in.
+
+        Notes are only loaded if notes is true.
+        """
+        self.with_notes = []
+        areas = [Area(Area.NO_AREA)]
+        areas.extend(self.areas())
+        for area in areas:
+            self.link_area(area)
+        if notes:
+            self.load_notes(self.with_notes)
+        else:
+            for item in self.with_notes:
+                item.notes = None
+        return areas
+
+    def fetch_notes(self, uuids):
+        """Yield (uuid, notes) for the uuids, with one query per NOTES_BATCH uuids."""
+        for start in range(0, len(uuids), self.NOTES_BATCH):
+            batch = uuids[start:start + self.NOTES_BATCH]
+            yield from self.query(self.NOTES % ', '.join('?' * len(batch)), batch)
+
+    def load_notes(self, items):
+        items = {item.uuid: item for item in items}
+        for uuid, notes in self.fetch_notes(list(items)):
+            items[uuid].notes = notes
+
+    def link_area(self, area):
+        area.tag_list = self.area_tags(area.uuid)
+        if area.uuid == 'NULL':
+            area.tasks = ()
+            area.projects = [Project.inbox()]
+            area.projects.extend(self.projects(area.uuid))
+        else:
+            area.tasks = self.tasks_in_area(area.uuid)
+            area.projects = self.projects(area.uuid)
+        for task in area.tasks:
+            self.link_task(task, area.level + 1)
+        for project in area.projects:
+            project.level = area.level + 1
+            project.tag_list, project.keywords = self.task_tags(project.uuid)
+            if project.notes:
+                self.with_notes.append(project)
+            project.items = self.tasks_in_project(project.uuid)
+            for item in project.items:
+                self.link_task(item, project.level + 1)
+
+    def link_task(self, task, level):
+        task.level = level
+        task.tag_list, task.keywords = self.task_tags(task.uuid)
+        if task.type == Task.ACTIONGROUP:
+            task.tasks = self.tasks_in_heading(task.uuid)
+            for subtask in task.tasks:
+                self.link_task(subtask, level + 1)
+        else:
+            if task.notes:
+                self.with_notes.append(task)
+            task.checklist = self.checklist_items(task.uuid) if task.checklistItemsCount else ()
+            for item in task.checklist:
+                item.level = level + 1
+
+    def areas(self):
+        return [Area(row) for row in self.query(Area.QUERY)]
+
+    def projects(self, area_uuid):
+        if area_uuid == 'NULL':
+            rows = self.query(Project.PROJECTS_WITHOUT_AREA)
+        else:
+            rows = self.query(Project.PROJECTS_IN_AREA, (area_uuid,))
+        return [Project(row) for row in rows]
+
+    def tasks_in_area(self, area_uuid):
+        return [Task.from_row(row) for row in self.query(Task.TASKS_IN_AREA_WITHOUT_PROJECT, (area_uuid,))]
+
+    def tasks_in_project(self, project_uuid):
+        if project_uuid == 'NULL':
+            rows = self.query(Task.TASKS_IN_INBOX)
+        else:
+            rows = self.query(Task.TASKS_IN_PROJECT, (project_uuid,))
+        return [Task.from_row(row) for row in rows]
+
+    def tasks_in_heading(self, heading_uuid):
+        return [Task(row) for row in self.query(Task.TASKS_IN_ACTION_GROUPS, (heading_uuid,))]
+
+    def task_tags(self, uuid):
+        titles = [title for title, in self.query(RowObjectWithTags.TAGS_QUERY, (uuid,))]
+        return TagIndex.normalize_task_tags(titles)
+
+    def area_tags(self, uuid):
+        return TagIndex.normalize([title for title, in self.query(Area.TAGS_QUERY, (uuid,))])
+
+    def checklist_items(self, task_uuid):
+        return [CheckListItem(row) for row in self.query(CheckListItem.items_of_task, (task_uuid,))]
+
+
+class BulkLoader(QueryLoader):
+    """
+    Read each table once and group the items by parent in memory.
+
+    The grouped lists keep the order of the per-level queries in QueryLoader,
+    so both loaders produce identical exports.
+    """
+
+    TASKS = """
+        SELECT %s, project, {heading}, "index"
+        FROM TMTask
+        WHERE trashed = 0
+        AND status < 2
+        ORDER BY type, "index";
+    """ % TaskObjects.COLUMNS
+    # reads every table once, indexes do not help
+    INDEXES = ()
+
+    def __init__(self, con):
+        super().__init__(con)
+        self._areas = QueryLoader.areas(self)
+        self._projects = {}
+        self._tasks_in_area = {}
+        self._tasks_in_project = {}
+        self._tasks_in_heading = {}
+        inbox = []
+        for row in self.query(self.TASKS):
+            if row[TaskObjects.TYPE] == TaskObjects.PROJECT:
+                project = Project(row)
+                self._projects.setdefault(project.area or 'NULL', []).append(project)
+                continue
+            project, heading, index = row[-3:]
+            task = Task.from_row(row)
+            if project is not None:
+                self._tasks_in_project.setdefault(project, []).append(task)
+            elif task.area is not None:
+                self._tasks_in_area.setdefault(task.area, []).append(task)
+            elif heading is None:
+                inbox.append((index, task))
+            if task.type == Task.TASK and heading is not None:
+                # a task that is also listed above is linked at another level,
+                # so it needs an object of its own (as in QueryLoader)
+                if project is not None or task.area is not None:
+                    task = Task.from_row(row)
+                self._tasks_in_heading.setdefault(heading, []).append(task)
+        # the inbox is ordered by "index" only, NULLs first as in ORDER BY
+        inbox.sort(key=lambda entry: (entry[0] is not None, entry[0] or 0))
+        self._tasks_in_project['NULL'] = [task for index, task in inbox]
+        self.tags = TagIndex(self.query)
+        self._checklist_items = CheckListItem.prefetch(self.query)
+
+    def areas(self):
+        return self._areas
+
+    def projects(self, area_uuid):
+        return self._projects.get(area_uuid, ())
+
+    def tasks_in_area(self, area_uuid):
+        return self._tasks_in_area.get(area_uuid, ())
+
+    def tasks_in_project(self, project_uuid):
+        return self._tasks_in_project.get(project_uuid, ())
+
+    def tasks_in_heading(self, heading_uuid):
+        return self._tasks_in_heading.get(heading_uuid, ())
+
+    def task_tags(self, uuid):
+        return self.tags.task_tags(uuid)
+
+    def area_tags(self, uuid):
+        return self.tags.area_tags(uuid)
+
+    def checklist_items(self, task_uuid):
+        return self._checklist_items.get(task_uuid, ())
+
+
+class Edges(object):
+    """Parent/child pairs collected while scanning, turned into CSR arrays later."""
+
+    def __init__(self):
+        self.parents = []
+        self.children = array('l')
+
+    def add(self, parent, child):
+        self.parents.append(parent)
+        self.children.append(child)
+
+    def csr(self, nodes, node_count):
+        """
+        Return (offsets, children): the children of node n are
+        children[offsets[n]:offsets[n + 1]], in the order they were added.
+
+        nodes maps parent keys to node numbers, edges to unknown parents
+        (e.g. to a completed project) are dropped.
+        """
+        parents = array('l', (nodes.get(parent, -1) for parent in self.parents))
+        offsets = array('l', [0]) * (node_count + 1)
+        for parent in parents:
+            if parent >= 0:
+                offsets[parent + 1] += 1
+        for n in range(node_count):
+            offsets[n + 1] += offsets[n]
+        children = array('l', [0]) * offsets[node_count]
+        position = offsets[:-1]
+        for parent, child in zip(parents, self.children):
+            if parent >= 0:
+                children[position[parent]] = child
+                position[parent] += 1
+        return offsets, children
+
+
+class Strings(object):
+    """
+    A column of strings, UTF-8 encoded into one buffer: string n is
+    data[offsets[n]:offsets[n + 1]], so it takes no Python object per row.
+    NULL is stored as an empty string and its row in nulls.
+    """
+
+    def __init__(self, strings=()):
+        self.data = bytearray()
+        self.offsets = array('q', [0])
+        self.nulls = set()
+        for string in strings:
+            self.append(string)
+
+    def append(self, string):
+        if string is None:
+            self.nulls.add(len(self.offsets) - 1)
+        else:
+            self.data += string.encode('utf-8')
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, n):
+        if n in self.nulls:
+            return None
+        return self.data[self.offsets[n]:self.offsets[n + 1]].decode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class ColumnarItems(object):
+    """The children of one node of a ColumnarStore."""
+
+    __slots__ = ('walk', 'offsets', 'children', 'node', 'level')
+
+    def __init__(self, walk, offsets, children, node, level):
+        self.walk = walk
+        self.offsets = offsets
+        self.children = children
+        self.node = node
+        self.level = level
+
+    def __len__(self):
+        return self.offsets[self.node + 1] - self.offsets[self.node]
+
+    def __iter__(self):
+        rows = self.children[self.offsets[self.node]:self.offsets[self.node + 1]]
+        return self.walk(rows, self.level)
+
+
+class ColumnarStore(QueryLoader):
+    """
+    Column-oriented store of all exported tasks, for databases with millions of rows.
+
+    Integer columns are kept in arrays, uuids, titles and notes in Strings
+    columns. The edges area -> project -> heading -> task -> checklist item
+    are CSR offset arrays. Walking the store fills one reusable item per
+    container (e.g. one Task for all tasks of a heading) instead of creating an
+    object per task.
+
+    The inbox is stored as an extra project row with uuid 'NULL', so it needs
+    no special handling when walking.
+    """
+
+    # a NULL "index" is stored as a value below all others, so the inbox is
+    # sorted like ORDER BY "index" (NULLs first)
+    NULL_INDEX = -2 ** 62
+
+    TASKS = """
+        SELECT uuid, title, notes <> '', area, project, {heading},
+               type, status, IFNULL(start, 0), CAST(IFNULL({startDate}, 0) AS INTEGER),
+               CAST(IFNULL({deadline}, 0) AS INTEGER), IFNULL("index", %d), IFNULL(checklistItemsCount, 0),
+               IFNULL(todayIndex, 0)
+        FROM TMTask
+        WHERE trashed = 0
+        AND status < 2
+        ORDER BY type, "index";
+    """ % NULL_INDEX
+    INDEXES = ()
+    # NULL is stored as 0, except for "index" (NULL_INDEX)
+    INT_COLUMNS = (('type', 'b'), ('status', 'b'), ('start', 'b'), ('startDate', 'l'),
+                   ('deadline', 'l'), ('index', 'l'), ('checklistItemsCount', 'l'), ('todayIndex', 'l'))
+
+    def __init__(self, con):
+        super().__init__(con)
+        self.areas = [Area(Area.NO_AREA)]
+        self.areas.extend(QueryLoader.areas(self))
+        self.tags = TagIndex(self.query)
+
+        self.uuid = Strings(['NULL'])
+        self.title = Strings(['Inbox'])
+        # the rows with notes, their text is read by load()
+        self.note_rows = array('l')
+        self.notes = None
+        for name, typecode in self.INT_COLUMNS:
+            setattr(self, name, array(typecode, [0]))
+        self.type[0] = Task.PROJECT
+        columns = [getattr(self, name) for name, typecode in self.INT_COLUMNS]
+
+        area_tasks, area_projects, project_items, heading_tasks = Edges(), Edges(), Edges(), Edges()
+        area_projects.add('NULL', 0)
+        rows = {'NULL': 0}
+        for row, (uuid, title, notes, area, project, heading, *values) in enumerate(self.query(self.TASKS), 1):
+            rows[uuid] = row
+            self.uuid.append(uuid)
+            self.title.append(title)
+            if notes:
+                self.note_rows.append(row)
+            for column, value in zip(columns, values):
+                column.append(value)
+            type_ = values[0]
+            if type_ == Task.PROJECT:
+                area_projects.add(area or 'NULL', row)
+                continue
+            if project is not None:
+                project_items.add(project, row)
+            elif area is not None:
+                area_tasks.add(area, row)
+            elif heading is None:
+                project_items.add('NULL', row)
+            if type_ == Task.TASK and heading is not None:
+                heading_tasks.add(heading, row)
+
+        areas = {area.uuid: node for node, area in enumerate(self.areas)}
+        self.area_tasks = area_tasks.csr(areas, len(self.areas))
+        self.area_projects = area_projects.csr(areas, len(self.areas))
+        self.project_items = project_items.csr(rows, len(rows))
+        self.heading_tasks = heading_tasks.csr(rows, len(rows))
+        # the inbox is ordered by "index" only
+        offsets, children = self.project_items
+        inbox = children[offsets[0]:offsets[1]]
+        children[offsets[0]:offsets[1]] = array('l', sorted(inbox, key=self.index.__getitem__))
+
+        checklist_items = Edges()
+        self.checklist_uuid = Strings()
+        self.checklist_title = Strings()
+        self.checklist_status = array('b')
+        for item, (uuid, title, status, task) in enumerate(self.query(CheckListItem.ALL_ITEMS)):
+            self.checklist_uuid.append(uuid)
+            self.checklist_title.append(title)
+            self.checklist_status.append(status)
+            checklist_items.add(task, item)
+        self.checklist_items = checklist_items.csr(rows, len(rows))
+
+    def load(self, notes=True):
+        if notes:
+            rows = {self.uuid[row]: row for row in self.note_rows}
+            texts = {rows[uuid]: text for uuid, text in self.fetch_notes(list(rows))}
+            self.notes = Strings(texts.get(row, '') for row in range(len(self.uuid)))
+        for node, area in enumerate(self.areas):
+            area.tag_list = self.area_tags(area.uuid)
+            area.tasks = ColumnarItems(self.walk, *self.area_tasks, node, area.level + 1)
+            area.projects = ColumnarItems(self.walk, *self.area_projects, node, area.level + 1)
+        return self.areas
+
+    def area_tags(self, uuid):
+        return self.tags.area_tags(uuid)
+
+    def walk(self, rows, level):
+        """Yield the items for rows, filled into one reusable item per type."""
+        items = {}
+        notes = self.notes
+        for row in rows:
+            type_ = self.type[row]
+            item = items.get(type_)
+            if item is None:
+                item = items[type_] = self.ITEM_CLASSES[type_]([None] * len(TaskObjects.FIELDS), level)
+            item.uuid = self.uuid[row]
+            item.title = self.title[row]
+            item.notes = (notes[row] or None) if notes is not None else None
+            item.type = type_
+            item.status = self.status[row]
+            item.start = self.start[row]
+            item.startDate = self.startDate[row]
+            item.deadline = self.deadline[row]
+            item.checklistItemsCount = self.checklistItemsCount[row]
+            item.todayIndex = self.todayIndex[row]
+            item.tag_list, item.keywords = self.tags.task_tags(item.uuid)
+            if type_ == Task.PROJECT:
+                item.items = ColumnarItems(self.walk, *self.project_items, row, level + 1)
+            elif type_ == Task.ACTIONGROUP:
+                item.tasks = ColumnarItems(self.walk, *self.heading_tasks, row, level + 1)
+            else:
+                item.checklist = ColumnarItems(self.walk_checklist, *self.checklist_items, row, level + 1)
+            yield item
+
+    def walk_checklist(self, items, level):
+        item = CheckListItem((), level)
+        for n in items:
+            item.uuid = self.checklist_uuid[n]
+            item.title = self.checklist_title[n]
+            item.status = self.checklist_status[n]
+            yield item
+
+    ITEM_CLASSES = {
+        Task.TASK: Task,
+        Task.PROJECT: Project,
+        Task.ACTIONGROUP: Heading,
+    }
+
+
+class StreamLoader(QueryLoader):
+    """
+    Read all exported items with one query, in output order.
+
+    The query returns every area, project, heading, task and checklist item
+    with its depth in the tree, sorted by area, project, heading, type and
+    "index" (the same order as the per-level queries). The rows are consumed in
+    batches and each item is yielded as soon as it is read. The depth is the
+    level of the item, so no parents are kept and memory does not grow with
+    the database.
+
+    This assumes the structure Things creates: a task belongs to at most one of
+    inbox, area, project or heading, and headings are always in a project.
+    """
+
+    STREAMING = True
+    INDEXES = ()
+
+    AREA = 0
+    TASK = 1
+    CHECKLIST_ITEM = 2
+
+    # pieces shared by the ITEMS queries: the selected fields, the TaskObjects
+    # columns of TMTask AS t and the tags of t and of TMArea AS a, joined by
+    # char(31) (the unit separator)
+    FIELDS = ', '.join(TaskObjects.FIELDS)
+    COLUMNS = ', '.join('t.notes' if name == 'notes' else TaskObjects.COLUMN_SQL.get(name, 't.' + name)
+                        for name in TaskObjects.FIELDS)
+    # for ITEMS_WITHOUT_NOTES, so notes are not even read with --no-notes
+    COLUMNS_WITHOUT_NOTES = ', '.join('NULL' if name == 'notes' else TaskObjects.COLUMN_SQL.get(name, 't.' + name)
+                                      for name in TaskObjects.FIELDS)
+    TASK_TAGS = """(SELECT group_concat(tag.title, char(31)) FROM TMTaskTag AS tt JOIN TMTag AS tag
+                    ON tag.uuid = tt.tags WHERE tt.tasks = t.uuid)"""
+    AREA_TAGS = """(SELECT group_concat(tag.title, char(31)) FROM TMAreaTag AS at JOIN TMTag AS tag
+                    ON tag.uuid = at.tags WHERE at.areas = a.uuid)"""
+
+    ITEMS = """
+        WITH
+        area AS (SELECT uuid, "index" AS idx FROM TMArea),
+        open AS (SELECT * FROM TMTask WHERE trashed = 0 AND status < 2),
+        project AS (
+            SELECT p.uuid, p."index" AS idx, a.idx AS area_idx, IFNULL(p.area, 'NULL') AS area_uuid
+            FROM open AS p LEFT JOIN area AS a ON a.uuid = p.area
+            WHERE p.type = 1
+            AND (p.area IS NULL OR a.uuid IS NOT NULL)
+        ),
+        -- the sort keys of every exported task: area, section (0: area,
+        -- 1: tasks in the area, 2: projects), project, item in the project
+        -- (-1: the project itself, then by type and "index") and task in a heading
+        item AS (
+            SELECT t.uuid, 1 AS depth, a.idx AS k1, a.uuid AS k2, 1 AS k3, NULL AS k4, NULL AS k5,
+                   t.type AS k6, t."index" AS k7, t.uuid AS k8, 0 AS k9, NULL AS k10, NULL AS k11
+            FROM open AS t JOIN area AS a ON a.uuid = t.area
+            WHERE t.type != 1 AND t.project IS NULL
+            UNION ALL
+            SELECT p.uuid, 1, p.area_idx, p.area_uuid, 2, p.idx, p.uuid, -1, NULL, NULL, 0, NULL, NULL
+            FROM project AS p
+            UNION ALL
+            SELECT t.uuid, 2, p.area_idx, p.area_uuid, 2, p.idx, p.uuid, t.type, t."index", t.uuid, 0, NULL, NULL
+            FROM open AS t JOIN project AS p ON p.uuid = t.project
+            WHERE t.type != 1
+            UNION ALL
+            SELECT t.uuid, 2, NULL, 'NULL', 2, NULL, 'NULL', 0, t."index", t.uuid, 0, NULL, NULL
+            FROM open AS t
+            WHERE t.type != 1 AND t.project IS NULL AND t.area IS NULL AND t.{heading} IS NULL
+            UNION ALL
+            SELECT t.uuid, 3, p.area_idx, p.area_uuid, 2, p.idx, p.uuid, h.type, h."index", h.uuid, 1, t."index", t.uuid
+            FROM open AS t JOIN open AS h ON h.uuid = t.{heading} JOIN project AS p ON p.uuid = h.project
+            WHERE t.type = 0 AND h.type = 2
+        )
+        SELECT kind, depth, {fields}, tags FROM (
+            SELECT 0 AS kind, 0 AS depth, 'NULL' AS uuid, NULL AS status, 'no area' AS title,
+                   NULL AS type, NULL AS notes, NULL AS area, NULL AS deadline, NULL AS startDate,
+                   NULL AS todayIndex, NULL AS checklistItemsCount, NULL AS stopDate, NULL AS start,
+                   NULL AS tags,
+                   NULL AS k1, 'NULL' AS k2, 0 AS k3, NULL AS k4, NULL AS k5, NULL AS k6, NULL AS k7,
+                   NULL AS k8, NULL AS k9, NULL AS k10, NULL AS k11, 0 AS k12, NULL AS k13
+            UNION ALL
+            SELECT 0, 0, a.uuid, NULL, a.title, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+                   {area_tags},
+                   a."index", a.uuid, 0, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, 0, NULL
+            FROM TMArea AS a
+            UNION ALL
+            SELECT 1, 1, 'NULL', NULL, 'Inbox', 1, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+                   NULL, 'NULL', 2, NULL, 'NULL', -1, NULL, NULL, 0, NULL, NULL, 0, NULL
+            UNION ALL
+            SELECT 1, i.depth, {columns}, {task_tags},
+                   i.k1, i.k2, i.k3, i.k4, i.k5, i.k6, i.k7, i.k8, i.k9, i.k10, i.k11, 0, NULL
+            FROM item AS i JOIN TMTask AS t ON t.uuid = i.uuid
+            UNION ALL
+            SELECT 2, i.depth + 1, c.uuid, c.status, c.title, NULL, NULL, NULL, NULL, NULL, NULL,
+                   NULL, NULL, NULL, NULL,
+                   i.k1, i.k2, i.k3, i.k4, i.k5, i.k6, i.k7, i.k8, i.k9, i.k10, i.k11, 1, c."index"
+            FROM item AS i JOIN TMTask AS t ON t.uuid = i.uuid JOIN TMChecklistItem AS c ON c.task = t.uuid
+            WHERE t.type != 2 AND t.checklistItemsCount
+        )
+        -- the no area root and its projects (k2 'NULL') come first, also
+        -- before areas with a NULL "index"
+        ORDER BY k2 <> 'NULL', k1, k2, k3, k4, k5, k6, k7, k8, k9, k10, k11, k12, k13;
+    """.replace('{fields}', FIELDS).replace('{columns}', COLUMNS).replace(
+        '{task_tags}', TASK_TAGS).replace('{area_tags}', AREA_TAGS)
+    ITEMS_WITHOUT_NOTES = ITEMS.replace(COLUMNS, COLUMNS_WITHOUT_NOTES)
+
+    # rows per fetchmany
+    BATCH = 1000
+
+    def stream(self, notes=True):
+        """Yield all exported items in output order, with their level set."""
+        cursor = self.query(self.ITEMS if notes else self.ITEMS_WITHOUT_NOTES)
+        while True:
+            rows = cursor.fetchmany(self.BATCH)
+            if not rows:
+                break
+            for kind, depth, *row, tags in rows:
+                item = self.make_item(kind, row, tags)
+                item.level = depth
+                yield item
+
+    def make_item(self, kind, row, tags):
+        tags = tags.split('\x1f') if tags else ()
+        if kind == self.AREA:
+            item = Area((row[0], row[2]))
+            item.tag_list = TagIndex.normalize(tags)
+        elif kind == self.TASK:
+            if row[TaskObjects.TYPE] == TaskObjects.PROJECT:
+                item = Project(row)
+            else:
+                item = Task.from_row(row)
+            item.tag_list, item.keywords = TagIndex.normalize_task_tags(tags)
+        else:
+            item = CheckListItem((row[0], row[2], row[1]))
+        return item
+
+
+class RecursiveLoader(StreamLoader):
+    """
+    Read all exported items with one recursive query, in output order.
+
+    The edge view lists every parent -> child link of the export tree (area ->
+    task or project, project -> task or heading, heading -> task, task ->
+    checklist item) with the sort key of the child among its siblings. The
+    recursive tree CTE walks the edges down from the areas and concatenates
+    the keys into a sort path, so sorting by path gives the export order and
+    SQLite does all of the filtering and ordering.
+
+    Unlike StreamLoader this follows the same links as the per-level queries,
+    so it makes no assumptions about the structure of the database. The no
+    area root has the node '' and the inbox the node ':inbox', which are
+    never uuids.
+    """
+
+    # a sibling sort key: a prefix (e.g. the type), "index" (NULLs first, as
+    # in ORDER BY) and the uuid, terminated by char(1), which sorts before
+    # every character of a uuid. A path is the keys from the root down, so
+    # parents sort before their children and children stay with their parent
+    KEY = "printf('%%s%%020d%%s', %s, IFNULL(%s, -4611686018427387904) + 4611686018427387904, %s) || char(1)"
+
+    ITEMS = """
+        WITH RECURSIVE
+        open AS (SELECT * FROM TMTask WHERE trashed = 0 AND status < 2),
+        edge(parent, kind, child, key) AS (
+            -- tasks and headings in an area come before its projects
+            SELECT area, 1, uuid, {area_task_key} FROM open
+            WHERE type != 1 AND project IS NULL AND area IS NOT NULL
+            UNION ALL
+            SELECT IFNULL(area, ''), 1, uuid, {project_key} FROM open
+            WHERE type = 1
+            UNION ALL
+            SELECT '', 1, ':inbox', '0' || char(1)
+            UNION ALL
+            SELECT ':inbox', 1, uuid, {inbox_task_key} FROM open
+            WHERE type != 1 AND project IS NULL AND area IS NULL AND {heading} IS NULL
+            UNION ALL
+            -- tasks without a heading come first
+            SELECT project, 1, uuid, {project_task_key} FROM open
+            WHERE type != 1 AND project IS NOT NULL
+            UNION ALL
+            SELECT {heading}, 1, uuid, {heading_task_key} FROM open
+            WHERE type = 0 AND {heading} IS NOT NULL
+            UNION ALL
+            SELECT c.task, 2, c.uuid, {checklist_item_key}
+            FROM TMChecklistItem AS c JOIN open AS t ON t.uuid = c.task
+            WHERE t.type != 2 AND t.checklistItemsCount
+        ),
+        tree(kind, depth, node, path) AS (
+            SELECT 0, 0, '', '0' || char(1)
+            UNION ALL
+            SELECT 0, 0, uuid, {area_key} FROM TMArea
+            UNION ALL
+            -- checklist items are the deepest level
+            SELECT e.kind, tree.depth + 1, e.child, tree.path || e.key
+            FROM tree JOIN edge AS e ON e.parent = tree.node
+            WHERE tree.depth < 4
+        )
+        SELECT kind, depth, {fields}, tags FROM (
+            SELECT 0 AS kind, 0 AS depth, 'NULL' AS uuid, NULL AS status, 'no area' AS title,
+                   NULL AS type, NULL AS notes, NULL AS area, NULL AS deadline, NULL AS startDate,
+                   NULL AS todayIndex, NULL AS checklistItemsCount, NULL AS stopDate, NULL AS start,
+                   NULL AS tags, '0' || char(1) AS path
+            UNION ALL
+            SELECT 0, 0, a.uuid, NULL, a.title, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+                   {area_tags}, tree.path
+            FROM tree JOIN TMArea AS a ON a.uuid = tree.node
+            WHERE tree.kind = 0
+            UNION ALL
+            SELECT 1, tree.depth, 'NULL', NULL, 'Inbox', 1, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+                   NULL, tree.path
+            FROM tree
+            WHERE tree.node = ':inbox'
+            UNION ALL
+            SELECT 1, tree.depth, {columns}, {task_tags}, tree.path
+            FROM tree JOIN TMTask AS t ON t.uuid = tree.node
+            WHERE tree.kind = 1
+            UNION ALL
+            SELECT 2, tree.depth, c.uuid, c.status, c.title, NULL, NULL, NULL, NULL, NULL, NULL,
+                   NULL, NULL, NULL, NULL, tree.path
+            FROM tree JOIN TMChecklistItem AS c ON c.uuid = tree.node
+            WHERE tree.kind = 2
+        )
+        ORDER BY path;
+    """.replace('{fields}', StreamLoader.FIELDS).replace('{columns}', StreamLoader.COLUMNS).replace(
+        '{task_tags}', StreamLoader.TASK_TAGS).replace('{area_tags}', StreamLoader.AREA_TAGS).replace(
+        '{area_key}', KEY % ("''", '"index"', 'uuid')).replace(
+        '{area_task_key}', KEY % ("'1' || type", '"index"', 'uuid')).replace(
+        '{project_key}', KEY % ("'2'", '"index"', 'uuid')).replace(
+        '{inbox_task_key}', KEY % ("''", '"index"', 'uuid')).replace(
+        '{project_task_key}', KEY % ('type', '"index"', 'uuid')).replace(
+        '{heading_task_key}', KEY % ("''", '"index"', 'uuid')).replace(
+        '{checklist_item_key}', KEY % ("''", 'c."index"', 'c.uuid'))
+    ITEMS_WITHOUT_NOTES = ITEMS.replace(StreamLoader.COLUMNS, StreamLoader.COLUMNS_WITHOUT_NOTES)
+
+
+class Schema(object):
+    """
+    The queries of the exporter, compiled for one version of the database.
+
+    Things 3.15 renamed the TMTask columns dueDate to deadline and actionGroup
+    to heading, and changed deadline and startDate from timestamps to its
+    packed date integers (see TaskObjects.parse_db_date). The query constants
+    use {deadline}, {startDate} and {heading} for these columns; older
+    databases get their timestamps converted to packed dates in SQL.
+
+    Schemas are cached by the database version and the definition of TMTask,
+    so exporting again (e.g. from the GUI) does not probe and compile again.
+    """
+
+    # every query constant, compiled up front
+    QUERIES = (
+        Area.QUERY, Area.TAGS_QUERY, RowObjectWithTags.TAGS_QUERY,
+        Project.PROJECTS_IN_AREA, Project.PROJECTS_WITHOUT_AREA,
+        Task.TASKS_IN_PROJECT, Task.TASKS_IN_AREA_WITHOUT_PROJECT, Task.TASKS_IN_INBOX,
+        Task.TASKS_IN_ACTION_GROUPS,
+        CheckListItem.items_of_task, CheckListItem.ALL_ITEMS,
+        TagIndex.TASK_TAGS, TagIndex.AREA_TAGS,
+        BulkLoader.TASKS, ColumnarStore.TASKS, StreamLoader.ITEMS, StreamLoader.ITEMS_WITHOUT_NOTES,
+        RecursiveLoader.ITEMS, RecursiveLoader.ITEMS_WITHOUT_NOTES,
+        CSVEmitter.TASKS,
+    )
+    # << and | have the same precedence in SQLite
+    TIMESTAMP_TO_DATE = """(
+        (CAST(strftime('%Y', {0}, 'unixepoch') AS INTEGER) << 16)
+        | (CAST(strftime('%m', {0}, 'unixepoch') AS INTEGER) << 12)
+        | (CAST(strftime('%d', {0}, 'unixepoch') AS INTEGER) << 7))"""
+    VERSION = re.compile(r'<integer>(\d+)</integer>')
+
+    CACHE = {}
+
+    def __init__(self, columns, version=None):
+        self.version = version
+        self.legacy = 'deadline' not in columns
+        if self.legacy:
+            self.columns = dict(deadline=self.TIMESTAMP_TO_DATE.format('dueDate'),
+                                startDate=self.TIMESTAMP_TO_DATE.format('startDate'),
+                                heading='actionGroup')
+        else:
+            self.columns = dict(deadline='deadline', startDate='startDate', heading='heading')
+        self.queries = {query: query.format(**self.columns) for query in self.QUERIES}
+
+    def sql(self, query):
+        try:
+            return self.queries[query]
+        except KeyError:
+            sql = self.queries[query] = query.format(**self.columns)
+            return sql
+
+    @classmethod
+    def probe(cls, con):
+        try:
+            value, = con.execute("SELECT value FROM Meta WHERE key = 'databaseVersion';").fetchone()
+            version = int(cls.VERSION.search(value).group(1))
+        except (sqlite3.Error, TypeError, AttributeError):
+            version = None
+        row = con.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'TMTask';").fetchone()
+        if row is None:
+            raise ValueError("not a Things 3 database (no table TMTask): %s"
+                             % (con.execute('PRAGMA database_list;').fetchone()[2] or 'in memory'))
+        table, = row
+        fingerprint = (version, table)
+        schema = cls.CACHE.get(fingerprint)
+        if schema is None:
+            columns = [row[1] for row in con.execute('PRAGMA table_info(TMTask);')]
+            schema = cls.CACHE[fingerprint] = cls(columns, version)
+            logging.info("database version %s, %s schema", version, 'legacy' if schema.legacy else 'current')
+        return schema
+
+
+LOADERS = {
+    ENGINE_BULK: BulkLoader,
+    ENGINE_QUERY: QueryLoader,
+    ENGINE_COLUMNAR: ColumnarStore,
+    ENGINE_STREAM: StreamLoader,
+    ENGINE_RECURSIVE: RecursiveLoader,
+}
 
 
 if __name__ == "__main__":
@@ -354,10 +2621,44 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Export tasks from Things3 database to TaskPaper.')
     parser.add_argument('--target', dest='target', action='store',
                         default=DEFAULT_TARGET,
-                        help='output folder (default: export_data')
+                        help='output folder, or file for --format all and --emitter csv, tsv or sqlite (default: %s)'
+                             % DEFAULT_TARGET)
+    parser.add_argument('--format', dest='format', action='store',
+                        choices=RowObject.FORMATS, default=RowObject.FMT_PROJECT,
+                        help='%s: one file, %s: one file per area, %s: one folder per area with one file '
+                             'per project (default)' % RowObject.FORMATS)
+    parser.add_argument('--emitter', dest='emitter', action='store',
+                        choices=sorted(EMITTERS), default=OrgEmitter.NAME,
+                        help='output format (default: %s)' % OrgEmitter.NAME)
+    parser.add_argument('--archive', dest='archive', action='store',
+                        help='write the files into this .tar.gz, .tar.xz or .zip archive instead of --target')
+    parser.add_argument('--stdout', dest='stdout', action='store_true',
+                        help='print everything to stdout instead of writing files')
     parser.add_argument('--db', dest='database', action='store',
                         default='main.sqlite',
                         help='path to the Things3 database (default: main.sqlite)')
+    parser.add_argument('--engine', dest='engine', action='store',
+                        choices=sorted(LOADERS), default=ENGINE_BULK,
+                        help='%s: read every table once (default), %s: one query per item, '
+                             '%s: compact column store for very large databases, '
+                             '%s: stream items in one query with constant memory, '
+                             '%s: stream items in one recursive query'
+                             % (ENGINE_BULK, ENGINE_QUERY, ENGINE_COLUMNAR, ENGINE_STREAM, ENGINE_RECURSIVE))
+    parser.add_argument('--no-notes', dest='notes', action='store_false',
+                        help='do not export notes')
+    parser.add_argument('--readonly', dest='readonly', action='store_true',
+                        help='open the database read-only (safe while Things is running)')
+    parser.add_argument('--immutable', dest='immutable', action='store_true',
+                        help='open the database read-only and without locking (only if Things is closed!)')
+    parser.add_argument('--snapshot', dest='snapshot', action='store_true',
+                        help='copy the database into memory first and export from the copy '
+                             '(indexed for the query engine if it is large)')
+
+    parser.add_argument('--explain', dest='explain', action='store_true',
+                        help='print the query plan and time of every query instead of exporting')
 
     args = parser.parse_args()
-    export(args)
+    if args.explain:
+        explain(args)
+    else:
+        export(args)
@@ -1 +1,50 @@
-python3 export_things.py --db test-data/Things-testdb.thingsdatabase/main.sqlite --format all --stdout
+# compare the exports of the test database with the golden files, with every emitter and engine
+db=test-data/Things-testdb.thingsdatabase/main.sqlite
+engines="bulk query columnar stream recursive"
+status=0
+tmp=$(mktemp -d)
+
+for emitter in taskpaper csv tsv ndjson json opml ics; do
+    golden=test-data/test-database-export.$emitter
+    # DTSTAMP is the day of the export
+    grep -v '^DTSTAMP:' $golden > "$tmp/golden"
+    for engine in $engines; do
+        python3 export_things.py --db $db --format all --stdout --emitter $emitter --engine $engine \
+            | grep -v '^DTSTAMP:' | diff - "$tmp/golden" \
+            && echo "$emitter $engine: ok" || { echo "$emitter $engine: differs from $golden"; status=1; }
+    done
+done
+
+# the rows of the sqlite export
+dump_sqlite() {
+    python3 -c "import json, sqlite3, sys
+con = sqlite3.connect(sys.argv[1])
+for table in ('area', 'project', 'heading', 'task', 'checklist_item', 'tag', 'item_tag'):
+    for row in con.execute('SELECT * FROM %s ORDER BY rowid;' % table):
+        print(table, json.dumps(row, ensure_ascii=False))" "$1"
+}
+for engine in $engines; do
+    python3 export_things.py --db $db --emitter sqlite --engine $engine --target "$tmp/$engine.sqlite" \
+        && dump_sqlite "$tmp/$engine.sqlite" | diff - test-data/test-database-export.sqlite.ndjson \
+        && echo "sqlite $engine: ok" || { echo "sqlite $engine: differs from test-data/test-database-export.sqlite.ndjson"; status=1; }
+done
+
+# the files of a folder export, with the files of a second emitter in the same folder (each has its own manifest)
+python3 export_things.py --db $db --target "$tmp/folder" \
+    && python3 export_things.py --db $db --target "$tmp/folder" --emitter taskpaper \
+    && (cd "$tmp/folder" && find . -type f | sort) | diff - test-data/test-database-export.files \
+    && echo "folder: ok" || { echo "folder: differs from test-data/test-database-export.files"; status=1; }
+
+# a task in a heading that also has a project is exported twice, the sqlite export stores it once
+cp $db "$tmp/heading-and-project.sqlite"
+python3 -c "import sqlite3, sys; con = sqlite3.connect(sys.argv[1]); \
+con.execute(\"UPDATE TMTask SET project = 'G8Y4buKDXenbu8vrvU6AFt' WHERE uuid = 'A7stZVu7c8GmsqiNHbZt4g'\"); \
+con.commit()" "$tmp/heading-and-project.sqlite"
+for engine in $engines; do
+    python3 export_things.py --db "$tmp/heading-and-project.sqlite" --engine $engine \
+        --emitter sqlite --target "$tmp/heading-and-project-$engine.sqlite" \
+        && echo "$engine: sqlite ok" || { echo "$engine: sqlite export of a task in a heading and a project failed"; status=1; }
+done
+
+rm -rf "$tmp"
+exit $status